@@ -0,0 +1,507 @@
+"""
+This file holds the batch driver of the pipeline.
+Every realm and stage it runs is recorded in a sqlite manifest, so an
+interrupted or crashed batch resumes with the realms that are not done yet.
+Workers are supervised: a realm that runs over its time or memory limit, or
+kills its worker, is recorded as failed, its worker is replaced and the realm
+goes to the back of the queue for a retry.
+Author: rvorias
+"""
+
+import glob
+import importlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import traceback
+from collections import deque
+from functools import lru_cache, partial
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+from pathlib import Path
+
+import click
+from omegaconf import OmegaConf
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+import logging
+logger = logging.getLogger("realms")
+
+sys.path.append("pipeline")
+from cache import hash_key
+from metrics import print_summary, on_stage
+
+# module with the run_pipeline of the job, and the outputs that mark a realm as done
+JOBS = {
+    "heights": {"module": "run", "outputs": "heights/height_{realm}.png", "metrics": True},
+    "directions": {"module": "run_direction", "outputs": "directions/{realm}_*.direction", "metrics": False},
+}
+
+
+def realm_outputs(job, realm, output_dir):
+    """Paths of the outputs `job` wrote for `realm`, empty if it has none."""
+    pattern = str(Path(output_dir) / JOBS[job]["outputs"].format(realm=realm))
+    return sorted(Path(p) for p in glob.glob(pattern))
+
+
+def outputs_hash(paths):
+    """Content hash of output files, their names included (directions live in the file name)."""
+    if not paths:
+        return None
+    return hash_key(*[p.name.encode() + p.read_bytes() for p in paths])
+
+
+class Manifest:
+    """Sqlite record of a batch: one row per realm and one per realm stage.
+    Only the main process writes to it, workers send their results back.
+    """
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS realms (
+                job TEXT, realm INTEGER, path TEXT, status TEXT, attempts INTEGER DEFAULT 0,
+                wall_s REAL, stage_keys TEXT, output_hash TEXT, error TEXT, updated REAL,
+                PRIMARY KEY (job, realm));
+            CREATE TABLE IF NOT EXISTS stages (
+                job TEXT, realm INTEGER, stage TEXT, status TEXT, wall_s REAL,
+                PRIMARY KEY (job, realm, stage));
+            CREATE TABLE IF NOT EXISTS failures (
+                job TEXT, realm INTEGER, attempt INTEGER, kind TEXT, stage TEXT,
+                wall_s REAL, error TEXT, time REAL);
+        """)
+
+    def done(self, job):
+        """{realm: output_hash} of the realms `job` finished."""
+        rows = self.db.execute("SELECT realm, output_hash FROM realms WHERE job = ? AND status = 'done'", (job,))
+        return dict(rows.fetchall())
+
+    def attempts(self, job):
+        """{realm: number of runs} of the realms `job` did not finish, failed or left 'running'."""
+        rows = self.db.execute("SELECT realm, attempts FROM realms WHERE job = ? AND status != 'done'", (job,))
+        return dict(rows.fetchall())
+
+    def mark_running(self, job, tasks):
+        """Flags the realms of `tasks` as dispatched, they stay 'running' if the batch is killed.
+        Realms that were done (redo, or their outputs are gone) start counting attempts from 0 again.
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO realms (job, realm, path, status, updated) VALUES (?, ?, ?, 'running', ?) "
+                "ON CONFLICT (job, realm) DO UPDATE SET status = 'running', path = excluded.path, "
+                "attempts = CASE WHEN status = 'done' THEN 0 ELSE attempts END, updated = excluded.updated",
+                [(job, realm, path, time.time()) for realm, path in tasks])
+
+    def record(self, result):
+        """Stores the result of run_realm."""
+        with self.db:
+            self.db.execute(
+                "UPDATE realms SET status = ?, attempts = attempts + 1, wall_s = ?, stage_keys = ?, "
+                "output_hash = ?, error = ?, updated = ? WHERE job = ? AND realm = ?",
+                (result["status"], result["wall_s"], json.dumps(result["stage_keys"]), result["output_hash"],
+                 result["error"], time.time(), result["job"], result["realm"]))
+            self.db.execute("DELETE FROM stages WHERE job = ? AND realm = ?", (result["job"], result["realm"]))
+            self.db.executemany(
+                "INSERT INTO stages (job, realm, stage, status, wall_s) VALUES (?, ?, ?, ?, ?)",
+                [(result["job"], result["realm"], s["stage"], "failed" if s["failed"] else "done", s["wall_s"])
+                 for s in result["stages"]])
+            if result["status"] == "failed":
+                self.db.execute(
+                    "INSERT INTO failures (job, realm, attempt, kind, stage, wall_s, error, time) "
+                    "SELECT job, realm, attempts, ?, ?, ?, error, ? FROM realms WHERE job = ? AND realm = ?",
+                    (result["kind"], result["stage"], result["wall_s"], time.time(), result["job"], result["realm"]))
+
+    def failures(self, job):
+        """(realm, attempt, kind, stage, error) of every failed run of `job`."""
+        rows = self.db.execute(
+            "SELECT realm, attempt, kind, stage, error FROM failures WHERE job = ? ORDER BY realm, attempt", (job,))
+        return rows.fetchall()
+
+    def counts(self, job):
+        """{status: number of realms} of `job`."""
+        rows = self.db.execute("SELECT status, COUNT(*) FROM realms WHERE job = ? GROUP BY status", (job,))
+        return dict(rows.fetchall())
+
+    def close(self):
+        self.db.close()
+
+
+def stage_records(output_dir, realm):
+    """Stage records run_pipeline wrote to the metrics dir, see metrics.RealmMetrics."""
+    try:
+        with open(Path(output_dir) / "metrics" / f"{realm}.json") as f:
+            return json.load(f)["stages"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+@lru_cache(maxsize=None)
+def load_job(job, config_path):
+    """Module and config of `job`, loaded once per worker.
+    The config is read-only, run_pipeline keeps per realm values in a RealmParams.
+    """
+    module = importlib.import_module(JOBS[job]["module"])
+    config = OmegaConf.load(config_path)
+    OmegaConf.set_readonly(config, True)
+    return module, config
+
+
+def warm_start(job, config_path):
+    """Worker initializer: imports the job and loads what its realms share before the first one."""
+    try:
+        module, config = load_job(job, config_path)
+        if hasattr(module, "warm_start"):
+            module.warm_start(config)
+    except Exception as e:
+        # the realms load it themselves and report the error where it belongs
+        logger.warning(f"warm start of {job} failed: {e}")
+
+
+def run_realm(task):
+    """Runs one realm in a pool worker, failures are returned instead of raised.
+
+    Args:
+        task:   (job, realm, realm_path, config_path)
+
+    Returns:
+        dict with the status, timings, stage keys and output hash of the realm.
+    """
+    job, realm, realm_path, config_path = task
+    result = {
+        "job": job, "realm": realm, "stage_keys": {}, "output_hash": None,
+        "error": None, "kind": None, "stage": None, "stages": []}
+    start = time.perf_counter()
+    output_dir = None
+    try:
+        module, config = load_job(job, config_path)
+        output_dir = config.pipeline.main_output_dir
+        keys = module.run_pipeline(realm_path, config)
+        result["stage_keys"] = keys or {}
+        result["output_hash"] = outputs_hash(realm_outputs(job, realm, output_dir))
+        result["status"] = "done" if result["output_hash"] else "failed"
+        if result["output_hash"] is None:
+            result["kind"] = "no_output"
+            result["error"] = "run_pipeline returned without writing its outputs"
+    except Exception as e:
+        result["status"] = "failed"
+        result["kind"] = "memory" if isinstance(e, MemoryError) else "exception"
+        result["error"] = traceback.format_exc()
+    result["wall_s"] = time.perf_counter() - start
+    if JOBS[job]["metrics"] and output_dir is not None:
+        result["stages"] = stage_records(output_dir, realm)
+    return result
+
+
+def limit_memory(mem_limit_mb):
+    """Caps the address space of this process, allocations above it raise MemoryError."""
+    if resource is None or not mem_limit_mb:
+        return
+    limit = int(mem_limit_mb) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def worker_loop(conn, mem_limit_mb=None, initializer=None, initargs=()):
+    """Body of a batch worker: runs the chunks of tasks it receives until it gets None.
+
+    Every realm is announced with ("start", realm, None), every Step with
+    ("stage", realm, stage) and the outcome with ("result", realm, run_realm(task)),
+    so the supervisor knows where a realm was when it has to be killed.
+    """
+    limit_memory(mem_limit_mb)
+    if initializer is not None:
+        initializer(*initargs)
+    current = {}
+
+    def report_stage(realm, stage):
+        current["stage"] = stage
+        conn.send(("stage", realm, stage))
+
+    on_stage(report_stage)
+    while True:
+        chunk = conn.recv()
+        if chunk is None:
+            break
+        for task in chunk:
+            current.clear()
+            conn.send(("start", task[1], None))
+            result = run_realm(task)
+            if result["status"] == "failed":
+                result["stage"] = current.get("stage")
+            conn.send(("result", task[1], result))
+    conn.close()
+
+
+class Worker:
+    """A batch process with its own pipe, a stuck one is killed without disturbing the others."""
+    def __init__(self, mem_limit_mb=None, initializer=None, initargs=()):
+        self.conn, child_conn = Pipe()
+        self.process = Process(
+            target=worker_loop, args=(child_conn, mem_limit_mb, initializer, initargs), daemon=True)
+        self.process.start()
+        child_conn.close()
+        # tasks sent and not reported yet, the first one is running
+        self.chunk = deque()
+        self.n_tasks = 0
+        self.started = None
+        self.stage = None
+
+    def send(self, chunk):
+        """Queues `chunk` and starts the clock, so a worker stuck in its initializer
+        or before announcing a realm times out as well. The clock restarts when the
+        worker announces the realm, which then gets the whole timeout."""
+        self.chunk.extend(chunk)
+        self.started = time.perf_counter()
+        self.stage = None
+        self.conn.send(chunk)
+
+    def stop(self):
+        """Lets the worker finish, then kills it if it does not."""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def failure_result(task, kind, stage, error, wall_s):
+    """Result of a realm that never returned from its worker."""
+    job, realm = task[:2]
+    return {
+        "job": job, "realm": realm, "status": "failed", "stage_keys": {}, "output_hash": None,
+        "error": error, "kind": kind, "stage": stage, "stages": [], "wall_s": wall_s}
+
+
+def supervise(tasks, pool_size, chunksize=1, maxtasksperchild=None, timeout_s=None, mem_limit_mb=None,
+              max_attempts=1, attempts=None, on_result=None, initializer=None, initargs=()):
+    """Runs `tasks` on `pool_size` supervised workers.
+
+    A worker whose realm runs longer than `timeout_s` or that dies is replaced,
+    the rest of its chunk is put back in the queue. Failed realms are queued
+    again at the back until they ran `max_attempts` times.
+
+    Args:
+        tasks:      run_realm tasks.
+        attempts:   {realm: runs before this batch}, counts towards `max_attempts`.
+        on_result:  callback(result, retry) for every finished run.
+        initializer, initargs: called in every new worker, as in multiprocessing.Pool.
+    """
+    pending = deque(tasks)
+    attempts = dict(attempts or {})
+    spawn = partial(Worker, mem_limit_mb, initializer, initargs)
+    workers = [spawn() for _ in range(min(pool_size, len(tasks)))]
+
+    def finish(task, result):
+        realm = task[1]
+        attempts[realm] = attempts.get(realm, 0) + 1
+        retry = result["status"] == "failed" and attempts[realm] < max_attempts
+        if retry:
+            pending.append(task)
+        if on_result is not None:
+            on_result(result, retry)
+
+    def replace(i, kind, error):
+        w = workers[i]
+        task = w.chunk.popleft()
+        w.kill()
+        pending.extendleft(reversed(w.chunk))
+        finish(task, failure_result(task, kind, w.stage, error, time.perf_counter() - w.started))
+        workers[i] = spawn()
+
+    try:
+        while pending or any(w.chunk for w in workers):
+            for i, w in enumerate(workers):
+                if w.chunk or not pending:
+                    continue
+                if not w.process.is_alive():
+                    w.kill()
+                    workers[i] = w = spawn()
+                elif maxtasksperchild and w.n_tasks >= maxtasksperchild:
+                    w.stop()
+                    workers[i] = w = spawn()
+                w.send([pending.popleft() for _ in range(min(chunksize, len(pending)))])
+
+            busy = {w.conn: i for i, w in enumerate(workers) if w.chunk}
+            for conn in wait(list(busy), timeout=1):
+                i = busy[conn]
+                w = workers[i]
+                try:
+                    kind, realm, payload = conn.recv()
+                except (EOFError, OSError):
+                    w.process.join(timeout=5)
+                    replace(i, "crash", f"worker died with exit code {w.process.exitcode} in stage {w.stage}")
+                    continue
+                if kind == "start":
+                    w.started = time.perf_counter()
+                    w.stage = None
+                elif kind == "stage":
+                    w.stage = payload
+                elif kind == "result":
+                    w.n_tasks += 1
+                    # the next realm of the chunk is waiting from now on
+                    w.started = time.perf_counter()
+                    finish(w.chunk.popleft(), payload)
+
+            if timeout_s:
+                now = time.perf_counter()
+                for i, w in enumerate(workers):
+                    if w.chunk and now - w.started > timeout_s:
+                        replace(i, "timeout", f"timed out after {timeout_s}s in stage {w.stage}")
+    finally:
+        for w in workers:
+            w.kill()
+    return attempts
+
+
+def find_realms(svg_dir):
+    """{realm number: svg path} of the svgs in `svg_dir`, svgs not named <number>.svg are skipped."""
+    realms = {}
+    for p in glob.glob(f"{svg_dir}/*.svg"):
+        stem = Path(p).stem
+        if not stem.isdigit():
+            logger.warning(f"skipping {p}, not a realm svg")
+            continue
+        realms[int(stem)] = p
+    return realms
+
+
+def run_batch(
+    job="heights",
+    config_path="pipeline/config.yaml",
+    realms=None,
+    limit=None,
+    redo=False,
+    verify=False,
+    retry_failed=False,
+    pool_size=None,
+    chunksize=None,
+    maxtasksperchild=None,
+    ):
+    """Runs `job` over all realm svgs that are not done yet.
+
+    A realm is done when the manifest says so and its outputs are still on disk,
+    with `verify` their content hash has to match the manifest as well.
+    Realms that failed `batch.max_attempts` times are skipped unless `retry_failed`.
+
+    Args:
+        realms:     realm numbers to consider, all svgs by default.
+        limit:      maximum number of realms to run.
+        redo:       rerun realms that are done.
+        pool_size, chunksize, maxtasksperchild: override the batch section of the config.
+
+    Returns:
+        {status: number of realms} of the job after the batch.
+    """
+    # the entry scripts call run_batch directly, progress is logged either way
+    logging.basicConfig(format="%(processName)s %(message)s")
+    logger.setLevel(logging.INFO)
+    config = OmegaConf.load(config_path)
+    output_dir = config.pipeline.main_output_dir
+    pool_size = pool_size or config.batch.pool_size or os.cpu_count()
+    chunksize = chunksize or config.batch.chunksize
+    maxtasksperchild = maxtasksperchild or config.batch.maxtasksperchild or None
+    max_attempts = config.batch.get("max_attempts") or 1
+
+    paths = find_realms(config.batch.svg_dir)
+    if realms:
+        paths = {r: paths[r] for r in realms if r in paths}
+    manifest = Manifest(config.batch.manifest)
+    done = {} if redo else manifest.done(job)
+    attempts = {} if retry_failed else manifest.attempts(job)
+
+    tasks = []
+    for realm in sorted(paths):
+        if realm in done:
+            outputs = realm_outputs(job, realm, output_dir)
+            if outputs and (not verify or outputs_hash(outputs) == done[realm]):
+                continue
+        if attempts.get(realm, 0) >= max_attempts:
+            continue
+        tasks.append((realm, paths[realm]))
+    if limit is not None:
+        tasks = tasks[:limit]
+
+    logger.info(f"{job}: {len(paths) - len(tasks)} realms done or given up on, starting with {len(tasks)}")
+    manifest.mark_running(job, tasks)
+    start = time.time()
+    n_finished = [0]
+
+    def on_result(result, retry):
+        manifest.record(result)
+        if retry:
+            manifest.mark_running(job, [(result["realm"], paths[result["realm"]])])
+        n_finished[0] += not retry
+        status = result["status"] if result["status"] == "done" else f"{result['kind']} in {result['stage']}"
+        logger.info(
+            f"[{n_finished[0]}/{len(tasks)}] realm {result['realm']} {status} after {result['wall_s']:.1f}s"
+            + (", queued for retry" if retry else ""))
+
+    supervise(
+        [(job, realm, path, config_path) for realm, path in tasks],
+        pool_size, chunksize, maxtasksperchild,
+        timeout_s=config.batch.get("realm_timeout_s"),
+        mem_limit_mb=config.batch.get("mem_limit_mb"),
+        max_attempts=max_attempts,
+        attempts=attempts,
+        on_result=on_result,
+        initializer=warm_start,
+        initargs=(job, config_path))
+
+    if tasks:
+        logger.info(f"{job}: {len(tasks)} realms in {time.time() - start:.1f}s")
+    counts = manifest.counts(job)
+    manifest.close()
+    if JOBS[job]["metrics"]:
+        print_summary(Path(output_dir) / "metrics")
+    return counts
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--job", type=click.Choice(list(JOBS)), default="heights")
+@click.option("--config", "config_path", default="pipeline/config.yaml")
+@click.option("--realm", "realms", type=int, multiple=True, help="only these realm numbers, repeatable")
+@click.option("--limit", type=int, default=None)
+@click.option("--redo", is_flag=True, help="rerun realms that are done")
+@click.option("--verify", is_flag=True, help="rehash outputs to decide which realms are done")
+@click.option("--retry-failed", is_flag=True, help="also rerun realms that used up their attempts")
+@click.option("--pool-size", type=int, default=None)
+@click.option("--chunksize", type=int, default=None)
+@click.option("--maxtasksperchild", type=int, default=None)
+def run(job, config_path, realms, limit, redo, verify, retry_failed, pool_size, chunksize, maxtasksperchild):
+    counts = run_batch(
+        job, config_path, realms, limit, redo, verify, retry_failed, pool_size, chunksize, maxtasksperchild)
+    print(counts)
+
+
+@cli.command()
+@click.option("--job", type=click.Choice(list(JOBS)), default="heights")
+@click.option("--config", "config_path", default="pipeline/config.yaml")
+def status(job, config_path):
+    config = OmegaConf.load(config_path)
+    manifest = Manifest(config.batch.manifest)
+    print(manifest.counts(job))
+    for realm, attempt, kind, stage, error in manifest.failures(job):
+        last_line = (error or "").strip().splitlines()[-1:]
+        print(f"realm {realm} attempt {attempt}: {kind} in {stage}: {''.join(last_line)}")
+    manifest.close()
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,92 @@
+"""
+This file holds helpers for the on-disk caches of the pipeline.
+Author: rvorias
+"""
+
+import os
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger("realms")
+
+
+def hash_key(*parts):
+    """Content hash of bytes and/or anything with a stable repr (numbers, tuples, strings)."""
+    sha = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode()
+        sha.update(part)
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def save_arrays(path, compressed=False, **arrays):
+    """Writes arrays to an .npz file atomically, concurrent workers never see half a file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+    (np.savez_compressed if compressed else np.savez)(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_arrays(path):
+    """Returns the arrays of an .npz file as a dict, or None if it is missing or unreadable."""
+    path = Path(path)
+    if not path.is_file():
+        return None
+    try:
+        with np.load(path) as data:
+            return {k: data[k] for k in data.files}
+    except (OSError, ValueError) as e:
+        logger.warning(f"ignoring unreadable cache file {path}: {e}")
+        return None
+
+
+def pack_ragged(arrays, width=2):
+    """Packs a list of (n_i, width) arrays into one flat array plus offsets."""
+    lengths = [len(a) for a in arrays]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    if not arrays:
+        return np.zeros((0, width)), offsets
+    return np.concatenate([np.asarray(a).reshape(-1, width) for a in arrays]), offsets
+
+
+def unpack_ragged(flat, offsets):
+    """Inverse of pack_ragged."""
+    return [flat[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def save_array_dir(path, **arrays):
+    """Writes arrays as .npy files into directory `path` so they can be memory-mapped.
+    The directory is filled under a temporary name and renamed, if another worker
+    got there first its copy is kept.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.mkdir(exist_ok=True)
+    for name, array in arrays.items():
+        np.save(tmp_path / f"{name}.npy", array)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        for f in tmp_path.iterdir():
+            f.unlink()
+        tmp_path.rmdir()
+
+
+def load_array_dir(path, mmap_mode="r"):
+    """Returns the .npy arrays of directory `path` as a dict (memory-mapped by default),
+    or None if it is missing or unreadable."""
+    path = Path(path)
+    if not path.is_dir():
+        return None
+    try:
+        return {f.stem: np.load(f, mmap_mode=mmap_mode) for f in path.glob("*.npy")}
+    except (OSError, ValueError) as e:
+        logger.warning(f"ignoring unreadable cache directory {path}: {e}")
+        return None
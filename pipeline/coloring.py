@@ -3,6 +3,9 @@ This file holds the logic for all things coloring.
 Author: rvorias
 """
 
+import json
+from functools import lru_cache
+
 import numpy as np
 from perlin_numpy import generate_perlin_noise_2d
 
@@ -320,11 +323,15 @@ def taiga_moss_1(hmap):
 #     ]
 # }
 
+@lru_cache(maxsize=None)
+def load_colors(path="resources/colors.json"):
+    """Biome colors, read once per process."""
+    with open(path, "r") as file:
+        return json.load(file)
+
 # coloring from file
 def color_from_json(hmap, biome):
-    import json
-    with open("resources/colors.json", "r") as file:
-        data = json.load(file)
+    data = load_colors()
     cmap = np.zeros((*hmap.shape, 3))
     for i, color in enumerate(data[biome]["colors"]):
         layer =  colorize_perlin(
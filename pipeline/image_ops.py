@@ -3,8 +3,8 @@ This file holds the logic for applying various operations to bitmasks and svgs.
 Author: rvorias
 """
 
+import os
 import logging
-from math import inf
 from random import choice, randint, uniform, random
 
 import numpy as np
@@ -13,24 +13,32 @@ from PIL import ImageDraw
 
 import matplotlib.pyplot as plt
 
-from reportlab.graphics.shapes import *
-
 logger = logging.getLogger("realms")
 
 
-def close_svg(drawing, islands_only=False, debug=False, output_size=400, scaling=1., lerp_points=None):
+def close_svg(paths, islands_only=False, debug=False, output_size=400, scaling=1.):
+    """Returns a single bitmap of close_svg_masks.
+
+    Args:
+        - islands_only: only return islands
+    """
+    mask, islands_mask = close_svg_masks(paths, debug=debug, output_size=output_size, scaling=scaling)
+    return islands_mask if islands_only else mask
+
+
+def close_svg_masks(paths, debug=False, output_size=400, scaling=1.):
     """This function tries to find open ends of paths and
     connects the ends while going around the image borders.
     
     Paths of lenght < 4 will be ignored.
     
     Args:
-        - drawing: the drawing containing paths from extractor.coast()
-        - rng: distance of the edge wrt center
-        - islands_only: only return islands
+        - paths: list of (n, 2) coast paths in pixel space,
+                 see viewbox_to_pixels() and get_coast_paths()
     
     Returns:
-        bitmap of closed islands
+        (bitmap of all closed islands, bitmap of the pure islands only),
+        both come from a single traversal and a single polygon pass
     """
     OUTPUT_SIZE = output_size
     SCALING = scaling
@@ -57,15 +65,10 @@ def close_svg(drawing, islands_only=False, debug=False, output_size=400, scaling
             raise ValueError(f"edge not within limits.")
 
     # Stage 1: find the first set of open paths and closed paths (islands)
-    # paths = drawing.contents[0].contents[0].contents
-
     arrays = []
     pure_islands = []
-    for shape_group in drawing.contents[0].contents:
-        path = shape_group.contents[0]
-        path.points = lerp_points(path.points)
-        plen = len(path.points)
-        split_array = [[path.points[x], path.points[x + 1]] for x in range(0, plen, 2)]
+    for path in paths:
+        split_array = np.asarray(path).tolist()
 
         # here we are injecting extra points
         if split_array[0] == split_array[-1]:
@@ -201,36 +204,13 @@ def close_svg(drawing, islands_only=False, debug=False, output_size=400, scaling
         arrays.append(np.vstack(line))
 
     # chain the paths
-    while len(arrays) > 0:
-        donts = []  # bookkeep which arrays to skip at the end
-        alen = len(arrays)
-        for i in range(alen):
-            a = arrays[i]
-            f1, l1 = a[0], a[-1]
-            for j in range(i + 1, alen):
-                b = arrays[j]
-                f2, l2 = b[0], b[-1]
-                if (l1 == f2).all():
-                    arrays[j] = np.vstack([a, b])
-                    donts.append(i)
-                    break
-                elif (l2 == f1).all():
-                    arrays[j] = np.vstack([b, a])
-                    donts.append(i)
-                    break
-                elif (f1 == f2).all():
-                    arrays[j] = np.vstack([np.flip(b, axis=0), a])
-                    donts.append(i)
-                    break
-                elif (l1 == l2).all():
-                    arrays[j] = np.vstack([a, np.flip(b, axis=0)])
-                    donts.append(i)
-                    break
-
-        arrays = [a for (i, a) in enumerate(arrays) if i not in donts]
-
-        new_islands, arrays = island_check(arrays)
-        islands.extend(new_islands)
+    rings, arrays = chain_paths(arrays)
+    islands.extend(rings)
+    if len(arrays) > 0:
+        logger.warning(
+            f"{len(arrays)} coast paths could not be closed, ends: "
+            f"{[(tuple(a[0]), tuple(a[-1])) for a in arrays]}"
+        )
 
     if debug:
         print(f"{len(islands)}")
@@ -243,21 +223,162 @@ def close_svg(drawing, islands_only=False, debug=False, output_size=400, scaling
         plt.ylim(RNG_0 - 100, RNG_1 + 100)
         plt.show()
 
-    if islands_only:
-        islands = pure_islands
-
     # Stage 5: scale and cast to PIL.Image
-    for i in range(len(islands)):
-        islands[i] = islands[i] * SCALING
-
+    # Closed paths of stage 1 are exactly the pure islands, the chained rings
+    # get bit 0 and the pure islands bits 0 and 1. Pure islands are drawn last
+    # so both masks can be read back from one image.
     base = PIL.Image.new("L", (OUTPUT_SIZE, OUTPUT_SIZE), 0)
     drawer = PIL.ImageDraw.Draw(base)
 
-    for island in islands:
-        drawer.polygon(list(island.flatten()), fill=1)
+    for ring in rings:
+        drawer.polygon(list((ring * SCALING).flatten()), fill=1)
+    for island in pure_islands:
+        drawer.polygon(list((island * SCALING).flatten()), fill=3)
 
     data = np.asarray(base)
-    return data
+    return data & 1, data >> 1
+
+
+def endpoint_key(point, decimals=6):
+    """Quantized, hashable version of a 2d point."""
+    return (round(float(point[0]), decimals), round(float(point[1]), decimals))
+
+
+def chain_paths(arrays):
+    """Links open paths that share end points into closed rings.
+    Every path is registered in a hash map under both of its end points,
+    rings are then walked path by path and concatenated once.
+
+    Args:
+        arrays: list of (n, 2) open paths.
+
+    Returns:
+        (rings, unclosed): closed (n, 2) rings and the chains that ran into
+        an end point without a partner.
+    """
+    ends = {}
+    for i, a in enumerate(arrays):
+        ends.setdefault(endpoint_key(a[0]), []).append((i, 0))
+        ends.setdefault(endpoint_key(a[-1]), []).append((i, -1))
+
+    used = [False] * len(arrays)
+    rings = []
+    unclosed = []
+    for start in range(len(arrays)):
+        if used[start]:
+            continue
+        used[start] = True
+        pieces = [arrays[start]]
+        first = endpoint_key(arrays[start][0])
+        node = endpoint_key(arrays[start][-1])
+        while node != first:
+            partner = next(((j, end) for j, end in ends[node] if not used[j]), None)
+            if partner is None:
+                break
+            j, end = partner
+            used[j] = True
+            b = arrays[j] if end == 0 else np.flip(arrays[j], axis=0)
+            pieces.append(b[1:])
+            node = endpoint_key(b[-1])
+
+        chain = np.vstack(pieces)
+        if node == first:
+            rings.append(chain)
+        else:
+            unclosed.append(chain)
+    return rings, unclosed
+
+
+def land_sea_votes(mask, centers):
+    """Counts how many heightline centers fall on land for the mask
+    as it is and for its inverse. Heightlines only exist on land,
+    so the orientation with the most votes is the right one.
+
+    Args:
+        mask:       (h, w) binary land mask.
+        centers:    (n, 2) array of (y, x) pixel coordinates.
+
+    Returns:
+        (votes for mask, votes for inverted mask)
+    """
+    centers = np.asarray(centers).reshape(-1, 2).astype(int)
+    if not len(centers):
+        return 0, 0
+    h, w = mask.shape
+    values = mask[centers[:, 0].clip(0, h - 1), centers[:, 1].clip(0, w - 1)] != 0
+    land = int(np.count_nonzero(values))
+    return land, len(values) - land
+
+
+def rasterize_polylines(paths, widths, output_size=400, piece_length=4., max_pixels=1 << 21):
+    """Draws anti-aliased polylines straight into a single channel array.
+    Replaces rendering a drawing to png and decoding it again.
+    Segments are cut into pieces of at most `piece_length` pixels, so every piece
+    fits a small window. Pieces with the same window size are drawn at once.
+    The distance to a segment is the smallest distance to its pieces, so the
+    coverage is the same as drawing the whole segment.
+
+    Args:
+        paths:          list of (n, 2) arrays of (x, y) pixel coordinates.
+        widths:         stroke width in pixels for each path.
+        output_size:    size of the square output.
+        piece_length:   longest piece in pixels.
+        max_pixels:     window pixels drawn per batch, bounds the memory.
+
+    Returns:
+        float32 array in [0, 1], 1 is fully covered by a stroke.
+    """
+    canvas = np.zeros((output_size, output_size), dtype=np.float32)
+    starts, ends, reaches = [], [], []
+    for path, width in zip(paths, widths):
+        path = np.asarray(path, dtype=np.float64)
+        if len(path) < 2:
+            continue
+        p0, p1 = path[:-1], path[1:]
+        n_pieces = np.maximum(np.ceil(np.hypot(*(p1 - p0).T) / piece_length), 1).astype(int)
+        segment = np.repeat(np.arange(len(p0)), n_pieces)
+        # position of each piece along its segment
+        k = np.arange(len(segment)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+        step = ((p1 - p0) / n_pieces[:, None])[segment]
+        starts.append(p0[segment] + k[:, None] * step)
+        ends.append(p0[segment] + (k + 1)[:, None] * step)
+        reaches.append(np.full(len(segment), width / 2 + 0.5))
+    if not starts:
+        return canvas
+    starts, ends, reaches = np.concatenate(starts), np.concatenate(ends), np.concatenate(reaches)
+
+    # thin and wide strokes are drawn in separate batches of their own window size
+    sizes = np.ceil(piece_length + 2 * reaches).astype(int) + 2
+    order = np.argsort(sizes, kind="stable")
+    starts, ends, reaches, sizes = starts[order], ends[order], reaches[order], sizes[order]
+    bounds = np.flatnonzero(np.diff(sizes)) + 1
+    batches = []
+    for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(sizes)]):
+        step = max(max_pixels // sizes[lo] ** 2, 1)
+        batches.extend((i, min(i + step, hi), sizes[lo]) for i in range(lo, hi, step))
+
+    for i, j, size in batches:
+        a, b, reach = starts[i:j], ends[i:j], reaches[i:j, None, None]
+        # window of each piece, (x, y) of its top left pixel
+        origin = np.floor(np.minimum(a, b) - reach[:, 0]).astype(int)
+        offsets = np.arange(size)
+        rows, cols = np.broadcast_arrays(
+            origin[:, 1, None, None] + offsets[None, :, None],
+            origin[:, 0, None, None] + offsets[None, None, :])
+
+        # distance of each pixel center to the piece
+        px = cols + 0.5 - a[:, 0, None, None]
+        py = rows + 0.5 - a[:, 1, None, None]
+        d = b - a
+        dx, dy = d[:, 0, None, None], d[:, 1, None, None]
+        length2 = dx * dx + dy * dy
+        t = np.divide(px * dx + py * dy, length2, out=np.zeros(px.shape), where=length2 > 0).clip(0, 1)
+        dist = np.hypot(px - t * dx, py - t * dy)
+
+        coverage = (reach - dist).clip(0, 1)
+        drawn = (coverage > 0) & (rows >= 0) & (rows < output_size) & (cols >= 0) & (cols < output_size)
+        np.maximum.at(canvas, (rows[drawn], cols[drawn]), coverage[drawn].astype(np.float32))
+    return canvas
 
 
 def put_cities(cities, hmap=None, cmap=None, extra_scaling=1., sealevel=0.3):
@@ -0,0 +1,145 @@
+"""
+This file holds the per-stage metrics of run_pipeline and their aggregation over a batch.
+Author: rvorias
+"""
+
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import click
+import numpy as np
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+import logging
+logger = logging.getLogger("realms")
+
+
+def peak_rss_kb():
+    """Peak resident memory of this process in KB, None where unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+# callbacks of stage_started, a batch worker uses them to report the stage it is in
+_stage_listeners = []
+
+
+def on_stage(callback):
+    """Registers callback(realm_number, stage), called whenever a utils.Step starts."""
+    _stage_listeners.append(callback)
+
+
+def stage_started(realm_number, stage):
+    for callback in _stage_listeners:
+        callback(realm_number, stage)
+
+
+class StageTimer:
+    """Measures wall time, CPU time and memory of one stage, see utils.Step."""
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+
+    def start(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.rss = peak_rss_kb()
+        if self.trace_memory:
+            if tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            else:
+                # (re)starting also clears the peak, reset_peak is python 3.9+
+                tracemalloc.stop()
+                tracemalloc.start()
+
+    def stop(self):
+        """Returns the measurements since start()."""
+        record = {
+            "wall_s": time.perf_counter() - self.wall,
+            "cpu_s": time.process_time() - self.cpu,
+        }
+        rss = peak_rss_kb()
+        if rss is not None:
+            # growth of the high water mark, 0 when the stage stayed below an earlier peak
+            record["rss_peak_delta_kb"] = rss - self.rss
+            record["rss_peak_kb"] = rss
+        if self.trace_memory:
+            record["traced_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        return record
+
+
+class RealmMetrics:
+    """Collects the stage records of one realm and writes them to `out_dir`/<realm>.json."""
+    def __init__(self, realm_number, out_dir=None, trace_memory=False):
+        self.realm_number = realm_number
+        self.out_dir = Path(out_dir) if out_dir else None
+        self.trace_memory = trace_memory
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def save(self):
+        if self.out_dir is None:
+            return
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.out_dir / f"{self.realm_number}.json", "w") as f:
+            json.dump({"realm_number": self.realm_number, "stages": self.records}, f, indent=1)
+
+
+def summarize(metrics_dir):
+    """Per stage p50/p95 of wall time, CPU time and peak memory growth over all realm records.
+
+    Returns:
+        {stage: {"n": count, "<measure>_p50": .., "<measure>_p95": ..}} in pipeline order.
+    """
+    values = {}
+    for path in sorted(Path(metrics_dir).glob("*.json")):
+        try:
+            with open(path) as f:
+                stages = json.load(f)["stages"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"skipping metrics file {path}: {e}")
+            continue
+        for record in stages:
+            stage = values.setdefault(record["stage"], {})
+            for measure in ("wall_s", "cpu_s", "rss_peak_delta_kb", "traced_peak_kb"):
+                if measure in record:
+                    stage.setdefault(measure, []).append(record[measure])
+
+    summary = {}
+    for name, measures in values.items():
+        summary[name] = {"n": len(measures["wall_s"])}
+        for measure, v in measures.items():
+            summary[name][f"{measure}_p50"] = float(np.percentile(v, 50))
+            summary[name][f"{measure}_p95"] = float(np.percentile(v, 95))
+    return summary
+
+
+def print_summary(metrics_dir="output/metrics"):
+    """Prints summarize() as a table."""
+    summary = summarize(metrics_dir)
+    print(f"{'stage':40s} {'n':>6s} {'wall p50':>9s} {'wall p95':>9s} {'cpu p50':>9s} {'cpu p95':>9s} {'rss+ p95':>10s}")
+    for name, s in summary.items():
+        print(
+            f"{name[:40]:40s} {s['n']:6d} {s['wall_s_p50']:8.2f}s {s['wall_s_p95']:8.2f}s "
+            f"{s['cpu_s_p50']:8.2f}s {s['cpu_s_p95']:8.2f}s "
+            f"{s.get('rss_peak_delta_kb_p95', 0) / 1024:8.1f}MB")
+
+
+@click.command()
+@click.argument("metrics_dir", default="output/metrics")
+def main(metrics_dir):
+    print_summary(metrics_dir)
+
+
+if __name__ == "__main__":
+    main()
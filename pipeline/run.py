@@ -7,38 +7,83 @@ import sys
 import click
 from omegaconf import OmegaConf
 from pathlib import Path
-import shutil
 
 import numpy as np
 import random as rand
-from random import choice
 
 import matplotlib.pyplot as plt
 import PIL
 import PIL.ImageOps
-import skimage
-import skimage.filters
+import scipy.ndimage
 
 import json
+from dataclasses import dataclass, asdict
 from functools import partial
 
 import logging
 
 logger = logging.getLogger("realms")
 
-sys.path.append("terrain-erosion-3-ways/")
-from river_network import *
 
 sys.path.append("pipeline")
-from svg_extraction import SVGExtractor, get_heightline_centers, get_city_coordinates
-from image_ops import close_svg, slice_cont, generate_city, put_cities, extract_land_sea_direction
+from svg_extraction import SVGExtractor, get_city_coordinates, load_realm_geometry
+from svg_extraction import viewbox_to_pixels, viewbox_transform
+from image_ops import close_svg_masks, land_sea_votes, slice_cont, generate_city, put_cities, extract_land_sea_direction, rasterize_polylines
 from utils import *
+from stages import ArtifactStore
+from metrics import RealmMetrics
 
 # from coloring import biomes, WATER_COLORS, color_from_json
 
+
+@dataclass(frozen=True)
+class RealmParams:
+    """Randomized parameters of one realm, drawn instead of written into the shared config.
+    evaporation_rate and coastal_dropoff used to be set on config.terrain, which
+    generate_terrain never reads. They are still drawn, in the same order, so
+    every realm keeps its terrain, but only the other two override config.terrain.land.
+    """
+    river_downcutting_constant: float
+    default_water_level: float
+    evaporation_rate: float
+    coastal_dropoff: float
+
+    @classmethod
+    def draw(cls, rng=rand):
+        return cls(
+            river_downcutting_constant=rng.uniform(0.1, 0.3),
+            default_water_level=rng.uniform(0.9, 1.1),
+            evaporation_rate=rng.uniform(0.1, 0.3),
+            coastal_dropoff=rng.uniform(70, 90),
+        )
+
+    def land(self, config):
+        """config.terrain.land with the realm parameters filled in."""
+        return {
+            **config.terrain.land,
+            "river_downcutting_constant": self.river_downcutting_constant,
+            "default_water_level": self.default_water_level,
+        }
+
+
+def warm_start(config):
+    """Loads what all realms of `config` share once per process: the land triangulation,
+    from cache_dir when it is there. Batch workers call it before their first realm.
+    """
+    land = config.terrain.land
+    tiling = config.terrain.get("tiling")
+    if tiling is not None and tiling.enabled:
+        # tiles come in several shapes, they are loaded as they show up
+        return
+    cache_dir = Path(config.pipeline.cache_dir) / "triangulation" if config.pipeline.get("cache_dir") else None
+    size = round(config.svg.output_size * config.pipeline.extra_scaling) + 2 * max(config.terrain.water_padding, 0)
+    load_triangulation((size, size), land.disc_radius, sampler=land.get("sampler", "python"), cache_dir=cache_dir)
+
+
 def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     HSCALES = config.terrain.height_scales
     OUTPUT_SIZE = config.svg.output_size
+    VIEWBOX = tuple(config.svg.viewbox)
 
     REL_SEA_SCALING = config.terrain.relative_sea_depth_scaling
     # hscale = choice(list(HSCALES))
@@ -46,6 +91,8 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     # PAD = config.pipeline.general_padding
     MAIN_OUTPUT_DIR = Path(config.pipeline.main_output_dir)
     RESOURCES_DIR = Path(config.pipeline.resources_dir)
+    CACHE_DIR = Path(config.pipeline.cache_dir) if config.pipeline.get("cache_dir") else None
+    DTYPE = np.dtype(config.pipeline.get("dtype", "float64"))
     wind_directions = ("E", "SE", "S", "SW", "W", "NW", "N", "NE")
 
     DEBUG_IMG_SIZE = (10, 10)
@@ -55,7 +102,11 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
         logger.setLevel(logging.INFO)
 
     realm_number = int(realm_path.replace("svgs/", "").replace("svgs\\", "").replace(".svg", "").replace("../", ""))
-    step = partial(Step, realm_number=realm_number)
+    metrics = RealmMetrics(
+        realm_number, MAIN_OUTPUT_DIR / "metrics", trace_memory=config.pipeline.get("trace_memory", False))
+    step = partial(Step, realm_number=realm_number, metrics=metrics, error_dir=MAIN_OUTPUT_DIR / "errors")
+    # outputs of the expensive stages are reused while their inputs stay the same
+    store = ArtifactStore(CACHE_DIR / "stages" if CACHE_DIR and config.pipeline.get("stage_cache") else None)
 
     with step("Creating output folder if needed"):
         
@@ -69,6 +120,7 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
             "hslices",
             "masks",
             "metadata",
+            "metrics",
             "palettes",
             "rivers",
         ]
@@ -83,93 +135,69 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
         np.random.seed(realm_number)
         rand.seed(realm_number)
 
-    with step("Randomizing config parameters"):
-        config.terrain.land.river_downcutting_constant = rand.uniform(0.1, 0.3)
-        config.terrain.land.default_water_level = rand.uniform(0.9, 1.1)
-        config.terrain.evaporation_rate = rand.uniform(0.1, 0.3)
-        config.terrain.coastal_dropoff = rand.uniform(70, 90)
-
-    with step("Setting up extractor"):
-        # Rescale svg on the viewbox
-        realm_data = ''
-        with open(realm_path, 'r') as file:
-            realm_data = file.read()
-        realm_data = realm_data.replace('height="400"', f'height="{OUTPUT_SIZE}"')
-        realm_data = realm_data.replace('width="400"', f'width="{OUTPUT_SIZE}"')
-        realm_data = realm_data.replace('viewBox="-500 -500 1000 1000"', 'viewBox="-450 -450 900 900"')
-
-        # Extract scaled svg
-        scaled_path = realm_path.replace(".svg", "_scaled.svg")
-        print("scaled_path:", scaled_path)
-        with open(scaled_path, 'w') as file:
-            file.write(realm_data)
-
-        # Extract scaled svg
-        extractor = SVGExtractor(scaled_path, scale=config.svg.scaling)
-
-        # delete scaled svg
-        Path.unlink(Path(scaled_path))
+    with step("Randomizing realm parameters"):
+        params = RealmParams.draw()
+        logger.debug(f"realm parameters: {params}")
+
+    with step("Loading realm geometry"):
+        # Rescale svg on the viewbox, parsed geometry is cached across runs
+        geometry, geometry_key = load_realm_geometry(
+            realm_path,
+            viewbox=VIEWBOX,
+            output_size=OUTPUT_SIZE,
+            scaling=config.svg.scaling,
+            cache_dir=CACHE_DIR / "geometry" if CACHE_DIR else None,
+        )
+        store.register("geometry", geometry_key)
 
         if debug:
+            extractor = SVGExtractor(
+                realm_path, scale=config.svg.scaling, backend="lxml", viewbox=VIEWBOX, output_size=OUTPUT_SIZE)
             extractor.show(DEBUG_IMG_SIZE)
 
     with step("Extracting coast"):
-        coast_drawing = extractor.coast()
+        coast_paths = viewbox_to_pixels(geometry.coast, VIEWBOX, OUTPUT_SIZE)
 
     with step("Extracting heightlines"):
-        heightline_drawing = extractor.height()
+        centers = viewbox_to_pixels(geometry.heightline_centers, VIEWBOX, OUTPUT_SIZE, order="yx")
 
     #############################################
     # MASKING
     #############################################
 
-    def map(value, inMin, inMax, outMin, outMax):
-        inSpan = inMax - inMin
-        outSpan = outMax - outMin
-        valueScaled = float(value - inMin) / float(inSpan)
-        return outMin + (valueScaled * outSpan)
-    
-    def lerp_point(point):
-        return map(point, -450, 450, 0, OUTPUT_SIZE)
-
-    # def lerp_np(arr):
-    #     return np.array(list(map(lerp_point, arr)))
-
-    def lerp_points(points_or_point):
-        if np.isscalar(points_or_point):
-            return lerp_point(points_or_point)
-        result = []
-        for p in points_or_point:
-            result.append(lerp_points(p))
-        return np.array(result) if isinstance(points_or_point, np.ndarray) else result
-
-    with step("Starting ground-sea mask logic"):
-        # uses a fixed padding of 32
-        # print(realm_number)
-        mask = close_svg(coast_drawing, debug=debug, output_size=OUTPUT_SIZE, scaling=config.svg.scaling, lerp_points=lerp_points)
-
-        centers = get_heightline_centers(heightline_drawing)
-        centers = lerp_points(centers)
-        sum = _sum = 0
-        _mask = (mask - 1) // 255
-        for center in centers:
-            sum += mask[int(center[0]), int(center[1])]
-            _sum += _mask[int(center[0]), int(center[1])]
-        if _sum > sum:
-            mask = _mask
-
-        # add islands
-        mask = mask + close_svg(coast_drawing, islands_only=True, debug=debug, output_size=OUTPUT_SIZE, scaling=config.svg.scaling, lerp_points=lerp_points)
-        mask = mask.clip(0, 1)
-
-        # extend land towards edges
-        # h, w = mask.shape
-        # for i in range(PAD):
-        #     mask[:, i] = mask[:, PAD]
-        #     mask[:, -i - 1] = mask[:, w - PAD]
-        #     mask[i, :] = mask[PAD, :]
-        #     mask[-i - 1, :] = mask[h - PAD, :]
-
+    with step("Starting ground-sea mask logic") as st:
+        cached = store.lookup(
+            "mask",
+            params=[OUTPUT_SIZE, config.svg.scaling, config.pipeline.mask_vote_margin],
+            upstream=["geometry"])
+        if cached is not None:
+            mask = cached["mask"]
+        else:
+            # uses a fixed padding of 32
+            # print(realm_number)
+            mask, islands_mask = close_svg_masks(coast_paths, debug=debug, output_size=OUTPUT_SIZE, scaling=config.svg.scaling)
+
+            votes, inverted_votes = land_sea_votes(mask, centers)
+            logger.debug(f"land/sea votes: {votes} as is, {inverted_votes} inverted")
+            if abs(votes - inverted_votes) <= config.pipeline.mask_vote_margin * (votes + inverted_votes):
+                logger.warning(f"realm {realm_number}: ambiguous land/sea orientation ({votes} vs {inverted_votes})")
+            if inverted_votes > votes:
+                mask = (mask - 1) // 255
+
+            # add islands
+            mask = mask + islands_mask
+            mask = mask.clip(0, 1)
+
+            # extend land towards edges
+            # h, w = mask.shape
+            # for i in range(PAD):
+            #     mask[:, i] = mask[:, PAD]
+            #     mask[:, -i - 1] = mask[:, w - PAD]
+            #     mask[i, :] = mask[PAD, :]
+            #     mask[-i - 1, :] = mask[h - PAD, :]
+            store.save("mask", mask=mask)
+
+        st.track(mask=mask)
         if debug:
             logger.debug(f"mask_shape: {mask.shape}")
             plt.figure(figsize=DEBUG_IMG_SIZE)
@@ -187,27 +215,37 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
             imshow(mask, "cropped mask")
 
     # ------------------------------------------------------------------------------
-    with step("----Extracting rivers"):
-        extractor.rivers()
-        rivers = np.asarray(extractor.get_img())  # rivers is now [0,255]
-        original_rivers = rivers.copy()
-
-        # make bit thicker
-        rivers = skimage.filters.gaussian(
-            rivers,
-            sigma=config.pipeline.river_gaussian / config.pipeline.extra_scaling,
-            channel_axis=-1
-        )[..., 0]  # rivers is now [0,1]
-        rivers = (rivers < 0.99) * 1
-        rivers = rivers.astype(np.uint8)
-        original_rivers = skimage.filters.gaussian(
-            original_rivers,
-            sigma=0.2,
-            channel_axis=-1
-        )[..., 0]  # rivers is now [0,1]
-        original_rivers = (original_rivers < 0.85) * 1
-        original_rivers = original_rivers.astype(np.uint8)
+    with step("----Extracting rivers") as st:
+        cached = store.lookup(
+            "rivers",
+            params=[VIEWBOX, OUTPUT_SIZE, config.svg.scaling, config.pipeline.river_gaussian,
+                    config.pipeline.extra_scaling, DTYPE.name],
+            upstream=["geometry"])
+        if cached is not None:
+            rivers, original_rivers = cached["rivers"], cached["original_rivers"]
+        else:
+            # stroke widths are in viewbox units
+            river_widths = geometry.river_widths * viewbox_transform(VIEWBOX, OUTPUT_SIZE)[0][0] * config.svg.scaling
+            river_paths = [path * config.svg.scaling for path in viewbox_to_pixels(geometry.rivers, VIEWBOX, OUTPUT_SIZE)]
+            river_ink = rasterize_polylines(river_paths, river_widths, output_size=OUTPUT_SIZE)  # 1 is river
+
+            # make bit thicker, same filter as skimage.filters.gaussian but keeps DTYPE
+            river_ink = river_ink.astype(DTYPE, copy=False)
+            rivers = scipy.ndimage.gaussian_filter(
+                river_ink,
+                sigma=config.pipeline.river_gaussian / config.pipeline.extra_scaling,
+                mode="nearest",
+            )
+            rivers = (rivers > 1 - 0.99).astype(np.uint8)
+            original_rivers = scipy.ndimage.gaussian_filter(
+                river_ink,
+                sigma=0.2,
+                mode="nearest",
+            )
+            original_rivers = (original_rivers > 1 - 0.85).astype(np.uint8)
+            store.save("rivers", rivers=rivers, original_rivers=original_rivers)
 
+        st.track(rivers=rivers, original_rivers=original_rivers)
         if debug:
             plt.figure(figsize=DEBUG_IMG_SIZE)
             plt.title("fat rivers")
@@ -238,21 +276,49 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     # ------------------------------------------------------------------------------
     # image_scaling
     if config.pipeline.extra_scaling != 1:
-        import scipy.ndimage
         final_mask = scipy.ndimage.zoom(final_mask, config.pipeline.extra_scaling, order=0)
         anti_final_mask = scipy.ndimage.zoom(anti_final_mask, config.pipeline.extra_scaling, order=0)
         rivers = scipy.ndimage.zoom(rivers, config.pipeline.extra_scaling, order=0)
         original_rivers = scipy.ndimage.zoom(original_rivers, config.pipeline.extra_scaling, order=0)
 
-    with step("----Terrain generation"):
+    with step("----Terrain generation") as st:
         wpad = config.terrain.water_padding
         if wpad > 0:
             wp = np.zeros(
                 (final_mask.shape[0] + 2 * wpad,
-                 final_mask.shape[1] + 2 * wpad))
+                 final_mask.shape[1] + 2 * wpad), dtype=final_mask.dtype)
             wp[wpad:-wpad, wpad:-wpad] = final_mask
             final_mask = wp
-        terrain_height = generate_terrain(final_mask, **config.terrain.land)
+        # only what generate_terrain reads, height scales and thread counts leave the terrain as is
+        tiling = config.terrain.get("tiling")
+        tiled = tiling is not None and tiling.enabled
+        land_key = {k: v for k, v in config.terrain.land.items() if k != "basin_workers"}
+        tiling_key = {k: v for k, v in tiling.items() if k != "workers"} if tiled else None
+        cached = store.lookup(
+            "terrain",
+            params=[land_key, wpad, tiling_key, asdict(params), config.pipeline.extra_scaling, DTYPE.name],
+            upstream=["mask", "rivers"],
+            seed=realm_number)
+        if cached is not None:
+            terrain_height = cached["terrain_height"]
+        else:
+            # the noise only depends on the realm, also when earlier stages came from the store
+            np.random.seed(realm_number)
+            if tiled:
+                terrain_height = generate_terrain_tiled(
+                    final_mask, **params.land(config),
+                    tile_size=tiling.tile_size, halo=tiling.halo, coarse_size=tiling.coarse_size,
+                    detail=tiling.detail, workers=tiling.workers,
+                    cache_dir=CACHE_DIR / "triangulation" if CACHE_DIR else None,
+                    dtype=DTYPE)
+            else:
+                terrain_height = generate_terrain(
+                    final_mask, **params.land(config),
+                    cache_dir=CACHE_DIR / "triangulation" if CACHE_DIR else None,
+                    dtype=DTYPE)
+            store.save("terrain", terrain_height=terrain_height)
+
+        st.track(final_mask=final_mask, terrain_height=terrain_height)
         if debug:
             plt.figure(figsize=DEBUG_IMG_SIZE)
             plt.title("terrain height")
@@ -268,7 +334,9 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     #              anti_final_mask.shape[1] + 2 * wpad)) * 255
     #         wp[wpad:-wpad, wpad:-wpad] = anti_final_mask
     #         anti_final_mask = wp
-    #     water_depth = generate_terrain(anti_final_mask, **config.terrain.water)
+    #     water_depth = generate_terrain(
+    #         anti_final_mask, **config.terrain.water,
+    #         cache_dir=CACHE_DIR / "triangulation" if CACHE_DIR else None)
 
     #     if debug:
     #         plt.figure(figsize=DEBUG_IMG_SIZE)
@@ -298,7 +366,8 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
 
     # ------------------------------------------------------------------------------
     with step("----Combining terrain and water heights"):
-        combined = terrain_height
+        # a copy, combined is rescaled in place below and terrain_height is exported as is
+        combined = terrain_height.copy()
 
         # final_mask = final_mask[wpad:-wpad, wpad:-wpad] if wpad > 0 else final_mask
         # _final_mask = final_mask < 255
@@ -335,46 +404,29 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     #############################################
 
     # with step("Extracting cities"):
-    #     cities_drawing = extractor.cities()
-    #     city_centers = get_city_coordinates(cities_drawing)
+    #     city_centers = get_city_coordinates(geometry.cities)
 
     #############################################
     # EXPORT 1
     #############################################
 
     with step("Scaling height map"):
-        hmap = norm(combined)
-
-        # transform the sea level
-        rescaled_coast_height = norm(0., combined)
-        # rescale the height of the map
+        # transform the sea level and rescale the height of the map above it
+        hmap, rescaled_coast_height = scale_height_map(combined, HSCALES[hscale])
         if debug:
             print(f"hmap_min = {hmap.min()}.")
             print(f"hmap_max = {hmap.max()}.")
             print(f"rescaled coast height = {rescaled_coast_height}.")
-        hmap = np.where(
-            hmap > rescaled_coast_height,
-            (hmap - rescaled_coast_height) * HSCALES[hscale] + rescaled_coast_height,
-            hmap
-        )
-        if debug:
             print(f"Rescaling hmap.")
             print(f"hmap_min = {combined.min()}.")
             print(f"hmap_max = {combined.max()}.")
             print(f"combined_min = {combined.min()}.")
             print(f"combined_max = {combined.max()}.")
         # also scale the combined map, as this will be used for coloring
-        combined = np.where(
-            combined > 0,
-            combined * HSCALES[hscale],
-            combined
-        )
+        np.multiply(combined, HSCALES[hscale], out=combined, where=combined > 0)
 
-        final_mask = np.where(
-            final_mask > 0,
-            final_mask * HSCALES[hscale],
-            final_mask
-        )
+        final_mask = final_mask.astype(DTYPE)
+        np.multiply(final_mask, HSCALES[hscale], out=final_mask, where=final_mask > 0)
 
         if debug:
             print(f"Rescaling combined by {HSCALES[hscale]}.")
@@ -413,8 +465,9 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     #         plt.imshow(hmap)
     #         plt.show()
 
-    with step("Exporting height map"):
-        hmap = (hmap * 255).astype(np.uint8)
+    with step("Exporting height map") as st:
+        st.track(hmap=hmap)
+        hmap = to_grey(hmap)
         himg = PIL.Image.fromarray(hmap).convert('LA')
 
         mask_img = PIL.Image.fromarray(final_mask).convert('L')
@@ -549,6 +602,7 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
         }
         with open(MAIN_OUTPUT_DIR / f"metadata/{realm_number}.json", "w") as json_file:
             json.dump(metadata, json_file)
+    metrics.save()
         
     
     # with step("Creating slices"):
@@ -588,6 +642,7 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
             # "water_depth": water_depth,
             "rivers": rivers,
             # "colormap": cmap_debug,
+            "stages": store.keys,
         }
 
     #############################################
@@ -600,6 +655,8 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     # --hm=32 \
     # --cm output/color_{realm_number}.png", shell=True)
 
+    return store.keys
+
 
 @click.command()
 @click.argument("realm_path")
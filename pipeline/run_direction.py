@@ -25,12 +25,10 @@ import logging
 
 logger = logging.getLogger("realms")
 
-sys.path.append("terrain-erosion-3-ways/")
-from river_network import *
 
 sys.path.append("pipeline")
-from svg_extraction import SVGExtractor, get_heightline_centers, get_city_coordinates
-from image_ops import close_svg, slice_cont, generate_city, put_cities, extract_land_sea_direction
+from svg_extraction import SVGExtractor, get_heightline_centers, get_city_coordinates, viewbox_to_pixels
+from image_ops import close_svg_masks, land_sea_votes, slice_cont, generate_city, put_cities, extract_land_sea_direction
 from utils import *
 
 # from coloring import biomes, WATER_COLORS, color_from_json
@@ -52,7 +50,7 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
         logger.setLevel(logging.INFO)
 
     realm_number = int(realm_path.replace("svgs/", "").replace("svgs\\", "").replace(".svg", "").replace("../", ""))
-    step = partial(Step, realm_number=realm_number)
+    step = partial(Step, realm_number=realm_number, error_dir=MAIN_OUTPUT_DIR / "errors")
 
     with step("Creating output folder if needed"):
         
@@ -80,22 +78,18 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
         np.random.seed(realm_number)
         rand.seed(realm_number)
 
-    with step("Randomizing config parameters"):
-        config.terrain.land.river_downcutting_constant = rand.uniform(0.1, 0.3)
-        config.terrain.land.default_water_level = rand.uniform(0.9, 1.1)
-        config.terrain.evaporation_rate = rand.uniform(0.1, 0.3)
-        config.terrain.coastal_dropoff = rand.uniform(70, 90)
-
     with step("Setting up extractor"):
-        extractor = SVGExtractor(realm_path, scale=config.svg.scaling)
+        extractor = SVGExtractor(realm_path, scale=config.svg.scaling, backend="lxml")
         if debug:
             extractor.show(DEBUG_IMG_SIZE)
 
     with step("Extracting coast"):
-        coast_drawing = extractor.coast()
+        # default close_svg output size
+        coast_paths = viewbox_to_pixels(extractor.coast(), extractor.geometry.viewbox, 400)
 
     with step("Extracting heightlines"):
-        heightline_drawing = extractor.height()
+        heightlines = extractor.height()
+        centers = viewbox_to_pixels(get_heightline_centers(heightlines), extractor.geometry.viewbox, 400, order="yx")
 
     #############################################
     # MASKING
@@ -104,19 +98,14 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     with step("Starting ground-sea mask logic"):
         # uses a fixed padding of 32
         print(realm_number)
-        mask = close_svg(coast_drawing, debug=debug)
+        mask, islands_mask = close_svg_masks(coast_paths, debug=debug)
 
-        centers = get_heightline_centers(heightline_drawing)
-        sum = _sum = 0
-        _mask = (mask - 1) // 255
-        for center in centers:
-            sum += mask[int(center[0]), int(center[1])]
-            _sum += _mask[int(center[0]), int(center[1])]
-        if _sum > sum:
-            mask = _mask
+        votes, inverted_votes = land_sea_votes(mask, centers)
+        if inverted_votes > votes:
+            mask = (mask - 1) // 255
 
         # add islands
-        mask += close_svg(coast_drawing, debug=debug, islands_only=True)
+        mask += islands_mask
         mask = mask.clip(0, 1)
 
         # extend land towards edges
@@ -137,11 +126,13 @@ def run_pipeline(realm_path, config="pipeline/config.yaml", debug=False):
     # -----------------------------------------------------------------------------
 
     with step("---Calculating land-sea direction"):
-        direction = extract_land_sea_direction(mask[PAD:-PAD,PAD:-PAD], debug=debug)
+        # mask[0:-0] would be empty
+        cropped = mask[PAD:-PAD,PAD:-PAD] if PAD > 0 else mask
+        direction = extract_land_sea_direction(cropped, debug=debug)
         with open(MAIN_OUTPUT_DIR / f"directions/{realm_number}_{direction:3f}.direction", "w") as file:
             file.write("")
         if debug:
-            imshow(mask[PAD:-PAD,PAD:-PAD], "cropped mask")
+            imshow(cropped, "cropped mask")
 
 @click.command()
 @click.argument("realm_path")
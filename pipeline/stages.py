@@ -0,0 +1,72 @@
+"""
+This file holds the stage cache of run_pipeline.
+Every stage is keyed on its inputs: the config values it reads, the keys of the
+stages it consumes and the realm seed. Its outputs are stored as .npz under
+that key, so a stage only reruns when one of its inputs changed.
+Author: rvorias
+"""
+
+import json
+import logging
+from pathlib import Path
+
+from omegaconf import OmegaConf, DictConfig, ListConfig
+
+from cache import hash_key, save_arrays, load_arrays
+
+logger = logging.getLogger("realms")
+
+# bump when the code of a stage changes its outputs
+STAGE_VERSION = 2
+
+
+def config_digest(value):
+    """Stable text of a config subtree or plain value."""
+    if isinstance(value, (DictConfig, ListConfig)):
+        value = OmegaConf.to_container(value, resolve=True)
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+class ArtifactStore:
+    """Content-addressed store of stage outputs.
+    Without a root it stores nothing, but still computes the stage keys.
+    """
+    def __init__(self, root=None):
+        self.root = Path(root) if root else None
+        self.keys = {}
+
+    def register(self, name, key):
+        """Records the key of a stage that is cached elsewhere, e.g. the svg geometry."""
+        self.keys[name] = key
+
+    def lookup(self, name, params=(), upstream=(), seed=None):
+        """Computes the key of stage `name` and returns its stored outputs.
+
+        Args:
+            params:     config subtrees and values the stage reads.
+            upstream:   names of the stages it consumes, they must be looked up first.
+            seed:       realm seed, for stages that draw random numbers.
+
+        Returns:
+            dict of arrays, or None if the stage has to run.
+        """
+        key = hash_key(
+            STAGE_VERSION, name,
+            *[config_digest(p) for p in params],
+            *[self.keys[u] for u in upstream],
+            seed)
+        self.keys[name] = key
+        if self.root is None:
+            return None
+        arrays = load_arrays(self.path(name))
+        if arrays is not None:
+            logger.info(f"    reusing cached {name} stage")
+        return arrays
+
+    def save(self, name, **arrays):
+        """Stores the outputs of stage `name` under the key of its last lookup."""
+        if self.root is not None:
+            save_arrays(self.path(name), compressed=True, **arrays)
+
+    def path(self, name):
+        return self.root / name / f"{self.keys[name]}.npz"
@@ -5,100 +5,208 @@ Author: rvorias
 
 import logging
 import copy
+import re
+from collections import deque
 import numpy as np
 import io
+from os import PathLike
+from pathlib import Path
 
-from svglib.svglib import svg2rlg
-from reportlab.graphics import renderPM
-from reportlab.graphics.shapes import *
+from lxml import etree
+
+from cache import hash_key, save_arrays, load_arrays, pack_ragged, unpack_ragged
 
-import PIL.Image
 import matplotlib.pyplot as plt
 
 logger = logging.getLogger('realms')
 
+# mode -> (reportlab shape class, strokeWidth filter)
+MODES = {
+    "coast": ("Path", 4.0),
+    "cities": ("Circle", None),
+    "height": ("Line", None),
+    "rivers": ("Path", 2.0),
+}
+
 class SVGExtractor:
-    def __init__(self, drawing_path, scale=2):
+    """Extracts the coast, heightlines, rivers and cities of a realm svg.
+
+    Args:
+        drawing_path:   path to the svg, its content as bytes or a parsed lxml tree.
+        scale:          scaling applied to the rendered drawing.
+        backend:        "svglib" returns reportlab drawings for every mode,
+                        "lxml" returns raw numpy geometry (see SVGGeometry) and
+                        never loads svglib/reportlab.
+        viewbox:        if given, rewrites the root viewBox (min_x, min_y, width, height).
+        output_size:    if given, rewrites the root width and height.
+    """
+    def __init__(self, drawing_path, scale=2, backend="svglib", viewbox=None, output_size=None):
         self.drawing_path = drawing_path
         self.scale = scale
+        self.backend = backend
+        self.viewbox = viewbox
+        self.output_size = output_size
         self.mode = None
-        self.load_drawing()
+        self.drawing_orig = None
+        if backend == "lxml":
+            if isinstance(drawing_path, (str, PathLike)):
+                with open(drawing_path, "rb") as file:
+                    self.drawing_path = file.read()
+            self.geometry = read_svg_geometry(self.drawing_path)
+            self.geometry.rescale(viewbox, output_size)
+        elif backend == "svglib":
+            self.load_drawing()
+        else:
+            raise ValueError(f"unknown svg backend: {backend}")
         self.drawing = self.drawing_orig
 
     def coast(self):
-        self.mode = "coast"
-        return self.get_cls(Path, "strokeWidth", 4.0)
+        return self.select("coast")
 
     def cities(self):
-        self.mode = "cities"
-        return self.get_cls(Circle)
+        return self.select("cities")
 
     def height(self):
-        self.mode = "height"
-        return self.get_cls(Line)
+        return self.select("height")
 
     def rivers(self):
-        self.mode = "rivers"
-        return self.get_cls(Path, "strokeWidth", 2.0)
+        return self.select("rivers")
+
+    def select(self, mode):
+        self.mode = mode
+        if self.backend == "lxml":
+            return self.geometry.select(mode)
+        return self.select_drawing(mode)
+
+    def select_drawing(self, mode):
+        from reportlab.graphics import shapes
+
+        svgclass, stroke_width = MODES[mode]
+        if stroke_width is None:
+            return self.get_cls(getattr(shapes, svgclass))
+        return self.get_cls(getattr(shapes, svgclass), "strokeWidth", stroke_width)
     
     def load_drawing(self):
-        self.drawing_orig = svg2rlg(self.drawing_path)
+        from svglib.svglib import SvgRenderer
+
+        svg = load_svg_tree(self.drawing_path)
+        rescale_svg(svg, self.viewbox, self.output_size)
+        source_path = self.drawing_path if isinstance(self.drawing_path, (str, PathLike)) else ""
+        self.drawing_orig = SvgRenderer(source_path).render(svg)
         print('svg drawing:', self.drawing_orig.width, self.drawing_orig.height)
         if self.scale > 1.0:
             self.drawing_orig.scale(self.scale, self.scale)
             self.drawing_orig.width *= self.scale
             self.drawing_orig.height *= self.scale
+        self.index_drawing()
+
+    def index_drawing(self):
+        """Walks the drawing once and buckets the shapes by (class, strokeWidth).
+        Values are lists of (position, shape) so document order can be restored.
+        """
+        from reportlab.graphics.shapes import Group
+
+        self.index = {}
+        for position, shape in enumerate(self.drawing_orig.contents[0].contents):
+            obj = shape.contents[0] if isinstance(shape, Group) else shape
+            key = (type(obj), getattr(obj, "strokeWidth", None))
+            self.index.setdefault(key, []).append((position, shape))
 
     def get_cls(self, svgclass, key=None, value=None):
-        # self.load_drawing()
-        self.drawing = copy.deepcopy(self.drawing_orig)
-        shape_group = self.drawing.contents[0]
-        contents = shape_group.contents
+        """Returns a lightweight drawing holding only the matching shapes.
+        The original drawing is never copied, matching shapes are shallow copies
+        so that callers can mutate them (strokeWidth, points) without side effects.
+        """
+        from reportlab.graphics.shapes import Group
+
+        entries = []
+        for (cls, stroke_width), shapes in self.index.items():
+            if not issubclass(cls, svgclass):
+                continue
+            if key == "strokeWidth" and stroke_width != value:
+                continue
+            entries.extend(shapes)
+        entries.sort(key=lambda entry: entry[0])
+
         new_contents = []
-        for shape in contents:
-            if isinstance(shape, Group):
-                obj = shape.contents[0]
-                if isinstance(obj, svgclass):
-                    if key:
-                        if obj.__dict__[key] == value:
-                            obj.__dict__[key] = 1.
-                            new_contents.append(shape)
-                    else:
-                        new_contents.append(shape)
-            elif isinstance(shape, svgclass):
-                new_contents.append(shape)
+        for _, shape in entries:
+            view = shape_view(shape)
+            obj = view.contents[0] if isinstance(view, Group) else view
+            if key:
+                if obj.__dict__[key] != value:
+                    continue
+                obj.__dict__[key] = 1.
+            new_contents.append(view)
 
+        shape_group = copy.copy(self.drawing_orig.contents[0])
         shape_group.contents = new_contents
+        self.drawing = copy.copy(self.drawing_orig)
         self.drawing.contents = [shape_group]
         return self.drawing
     
-    def get_img(self):
-        if self.mode == "rivers":
-            for i, _ in enumerate(self.drawing.contents[0].contents):
-                put_downstream(i, self.drawing.contents[0].contents)
-
-        buffer = io.BytesIO()
-        renderPM.drawToFile(self.drawing, buffer, fmt="PNG")
-        img = PIL.Image.open(buffer)
-        return img
-    
     def show(self, size=(10, 10)):
+        """Plots the coast and the rivers, with their trunk widths, as the pipeline rasterizes them."""
+        from image_ops import rasterize_polylines
+
+        geometry = self.geometry if self.backend == "lxml" else read_svg_geometry(self.drawing_path)
+        viewbox = self.viewbox or geometry.viewbox
+        output_size = self.output_size or round(parse_length(geometry.width, viewbox[2]))
+        coast = viewbox_to_pixels(geometry.select("coast"), viewbox, output_size)
+        rivers = viewbox_to_pixels(geometry.select("rivers"), viewbox, output_size)
+        river_widths = get_river_widths(geometry.select("rivers")) * viewbox_transform(viewbox, output_size)[0][0]
+        img = np.maximum(
+            rasterize_polylines([p * self.scale for p in coast], [self.scale] * len(coast), output_size),
+            rasterize_polylines([p * self.scale for p in rivers], river_widths * self.scale, output_size))
         plt.figure(figsize=size)
-        plt.imshow(self.get_img())
+        plt.imshow(img, cmap="gray_r")
         plt.show()
 
-def put_downstream(idx, shape_groups):
-    """Give rivers a wider trunk based on the number of branches."""
-    shape_groups[idx].contents[0].strokeWidth += .5
-    
-    this_end_x, this_end_y = shape_groups[idx].contents[0].points[-2:]
-    for j, shape_group in enumerate(shape_groups):
-        river = shape_group.contents[0]
-        other_start_x, other_start_y = river.points[:2]
-        if this_end_x == other_start_x and this_end_y == other_start_y:
-            put_downstream(j, shape_groups)
-    
-    return shape_groups
+def shape_view(shape):
+    """Shallow copy of a shape (and of the leaf if it is wrapped in a Group)."""
+    from reportlab.graphics.shapes import Group
+
+    if not isinstance(shape, Group):
+        return copy.copy(shape)
+    view = copy.copy(shape)
+    view.contents = [copy.copy(shape.contents[0])] + shape.contents[1:]
+    return view
+
+def get_river_widths(paths):
+    """Trunk width of each (n, 2) river path.
+
+    Rivers start at a width of 1 and widen by .5 for every walk that reaches
+    them from upstream, a river flows into every river starting at its end point.
+    Rivers are linked through a hash map of start points and the walks are
+    accumulated in a single topological pass, so this is linear in the number
+    of rivers.
+    """
+    n_rivers = len(paths)
+    starts = {}
+    for j, path in enumerate(paths):
+        if len(path):
+            starts.setdefault(tuple(path[0]), []).append(j)
+    downstream = [starts.get(tuple(path[-1]), []) if len(path) else [] for path in paths]
+
+    n_upstream = np.zeros(n_rivers, dtype=np.int64)
+    for targets in downstream:
+        for j in targets:
+            n_upstream[j] += 1
+
+    walks = np.ones(n_rivers)
+    queue = deque(i for i in range(n_rivers) if n_upstream[i] == 0)
+    n_done = 0
+    while queue:
+        i = queue.popleft()
+        n_done += 1
+        for j in downstream[i]:
+            walks[j] += walks[i]
+            n_upstream[j] -= 1
+            if n_upstream[j] == 0:
+                queue.append(j)
+
+    if n_done < n_rivers:
+        logger.warning(f"{n_rivers - n_done} river segments form a loop, their trunks are not widened further.")
+    return 1. + .5 * walks
 
 def get_coast_coordinates(drawing, scaling=1):
     """Returns a flat numpy array of size (n,2)."""
@@ -114,21 +222,335 @@ def get_coast_coordinates(drawing, scaling=1):
 
     return ans
 
-def get_city_coordinates(drawing, scaling=1):
-    """Calculated in uncropped coordinates"""
+def get_city_coordinates(cities, scaling=1):
+    """Calculated in uncropped coordinates.
+    Accepts a drawing from extractor.cities() or an (n, 3) array of cx, cy, r.
+    """
+    if not isinstance(cities, np.ndarray):
+        cities = [(circle.cx, circle.cy, circle.r) for circle in cities.contents[0].contents]
     centers = []
-    for circle in drawing.contents[0].contents: 
+    for cx, cy, r in cities:
         centers.append((
-            int(circle.cy*.4+200)*scaling,
-            int(circle.cx*.4+200)*scaling,
-            circle.r
+            int(cy*.4+200)*scaling,
+            int(cx*.4+200)*scaling,
+            r
         ))
     return centers
 
-def get_heightline_centers(drawing, scaling=1):
-    line_coordinates = []
-    for line in drawing.contents[0].contents:
-        line_center = [(line.y2+line.y1)/2, (line.x2+line.x1)/2]
-        line_coordinates.append(line_center)
-    line_coordinates = np.vstack(line_coordinates)
+def get_heightline_centers(lines, scaling=1):
+    """Returns the (y, x) centers of the heightlines as an (n, 2) array.
+    Accepts a drawing from extractor.height() or an (n, 4) array of x1, y1, x2, y2.
+    """
+    if not isinstance(lines, np.ndarray):
+        lines = np.array([
+            (line.x1, line.y1, line.x2, line.y2)
+            for line in lines.contents[0].contents
+        ], dtype=np.float64).reshape(-1, 4)
+    line_coordinates = np.stack([
+        (lines[:, 3] + lines[:, 1]) / 2,
+        (lines[:, 2] + lines[:, 0]) / 2,
+    ], axis=1)
     return line_coordinates * scaling
+
+def viewbox_transform(viewbox, output_size):
+    """Returns (scale, offset) per (x, y) axis so that pixels = points * scale + offset."""
+    min_x, min_y, width, height = viewbox
+    scale = np.array([output_size / width, output_size / height])
+    offset = -np.array([min_x, min_y]) * scale
+    return scale, offset
+
+def viewbox_to_pixels(points, viewbox, output_size, order="xy"):
+    """Affine map from viewBox coordinates to pixel space.
+
+    Args:
+        points:         array of shape (..., 2) or a list of (n, 2) arrays,
+                        lists are transformed in a single call and split again.
+        viewbox:        (min_x, min_y, width, height).
+        output_size:    size of the square pixel space.
+        order:          "xy" or "yx", the coordinate order of the last axis.
+
+    Returns:
+        float64 array(s) in the same layout as `points`.
+    """
+    scale, offset = viewbox_transform(viewbox, output_size)
+    if order == "yx":
+        scale, offset = scale[::-1], offset[::-1]
+
+    if isinstance(points, (list, tuple)):
+        if len(points) == 0:
+            return []
+        lengths = [len(p) for p in points]
+        flat = np.concatenate([np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in points])
+        flat = flat * scale + offset
+        return np.split(flat, np.cumsum(lengths)[:-1])
+    return np.asarray(points, dtype=np.float64) * scale + offset
+
+def get_coast_paths(drawing):
+    """Returns the paths of a drawing from extractor.coast() as a list of (n, 2) arrays."""
+    return [
+        np.asarray(shape_group.contents[0].points, dtype=np.float64).reshape(-1, 2)
+        for shape_group in drawing.contents[0].contents
+    ]
+
+#############################################
+# Realm geometry and its cache
+#############################################
+
+# bump when the extraction logic changes to invalidate cached geometry
+GEOMETRY_VERSION = 1
+
+class RealmGeometry:
+    """Everything run_pipeline needs from a realm svg, in viewBox coordinates.
+
+    Attributes:
+        coast:              list of (n, 2) coast paths.
+        rivers:             list of (n, 2) river paths.
+        river_widths:       trunk width of each river, see get_river_widths.
+        heightline_centers: (n, 2) array of (y, x) heightline centers.
+        cities:             (n, 3) array of cx, cy, r.
+        viewbox:            (min_x, min_y, width, height).
+    """
+    def __init__(self, coast, rivers, river_widths, heightline_centers, cities, viewbox):
+        self.coast = coast
+        self.rivers = rivers
+        self.river_widths = river_widths
+        self.heightline_centers = heightline_centers
+        self.cities = cities
+        self.viewbox = viewbox
+
+    @classmethod
+    def from_extractor(cls, extractor):
+        """Expects an extractor with the lxml backend."""
+        rivers = extractor.rivers()
+        return cls(
+            coast=extractor.coast(),
+            rivers=rivers,
+            river_widths=get_river_widths(rivers),
+            heightline_centers=get_heightline_centers(extractor.height()),
+            cities=extractor.cities(),
+            viewbox=extractor.geometry.viewbox,
+        )
+
+    def to_arrays(self):
+        coast, coast_offsets = pack_ragged(self.coast)
+        rivers, river_offsets = pack_ragged(self.rivers)
+        return {
+            "coast": coast,
+            "coast_offsets": coast_offsets,
+            "rivers": rivers,
+            "river_offsets": river_offsets,
+            "river_widths": np.asarray(self.river_widths, dtype=np.float64),
+            "heightline_centers": self.heightline_centers,
+            "cities": self.cities,
+            "viewbox": np.asarray(self.viewbox, dtype=np.float64),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(
+            coast=unpack_ragged(arrays["coast"], arrays["coast_offsets"]),
+            rivers=unpack_ragged(arrays["rivers"], arrays["river_offsets"]),
+            river_widths=arrays["river_widths"],
+            heightline_centers=arrays["heightline_centers"],
+            cities=arrays["cities"],
+            viewbox=tuple(float(v) for v in arrays["viewbox"]),
+        )
+
+def load_realm_geometry(realm_path, viewbox=None, output_size=None, scaling=1., cache_dir=None):
+    """Returns the RealmGeometry of a realm svg, going through a content addressed
+    cache keyed by the svg content and the extraction parameters.
+    Without `cache_dir` the svg is always parsed.
+
+    Returns:
+        (RealmGeometry, cache key)
+    """
+    with open(realm_path, "rb") as file:
+        svg_data = file.read()
+    key = hash_key(svg_data, GEOMETRY_VERSION, viewbox and tuple(viewbox), output_size, scaling)
+
+    cache_path = Path(cache_dir) / f"{key}.npz" if cache_dir else None
+    if cache_path is not None:
+        arrays = load_arrays(cache_path)
+        if arrays is not None:
+            logger.info(f"geometry cache hit: {cache_path}")
+            return RealmGeometry.from_arrays(arrays), key
+
+    extractor = SVGExtractor(svg_data, scale=scaling, backend="lxml", viewbox=viewbox, output_size=output_size)
+    geometry = RealmGeometry.from_extractor(extractor)
+    if cache_path is not None:
+        save_arrays(cache_path, **geometry.to_arrays())
+    return geometry, key
+
+#############################################
+# Streaming geometry reader
+#############################################
+
+class SVGGeometry:
+    """Raw vector data of an svg in viewBox coordinates, grouped by stroke width.
+
+    Attributes:
+        width, height:  root svg size attributes (as strings).
+        viewbox:        root viewBox as (min_x, min_y, width, height).
+        paths:          stroke width -> list of (n, 2) point arrays.
+        lines:          stroke width -> (n, 4) array of x1, y1, x2, y2.
+        circles:        stroke width -> (n, 3) array of cx, cy, r.
+    """
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.viewbox = None
+        self.paths = {}
+        self.lines = {}
+        self.circles = {}
+
+    def rescale(self, viewbox=None, output_size=None):
+        """Same root rewrite as rescale_svg, the raw coordinates are unaffected."""
+        if viewbox is not None:
+            self.viewbox = tuple(float(v) for v in viewbox)
+        if output_size is not None:
+            self.width = self.height = str(output_size)
+
+    def select(self, mode):
+        """Geometry equivalent of the SVGExtractor modes."""
+        svgclass, stroke_width = MODES[mode]
+        if svgclass == "Path":
+            return self.paths.get(stroke_width, [])
+        if svgclass == "Line":
+            return stack_groups(self.lines, 4)
+        return stack_groups(self.circles, 3)
+
+def stack_groups(groups, width):
+    if not groups:
+        return np.zeros((0, width))
+    return np.vstack(list(groups.values()))
+
+SVG_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+SVG_PATH_TOKEN = re.compile(rf"[MmLlHhVvZzCcSsQqTtAa]|{SVG_NUMBER}")
+SVG_PATH_ARITY = {"M": 2, "L": 2, "H": 1, "V": 1, "Z": 0, "C": 6, "S": 4, "Q": 4, "T": 2, "A": 7}
+
+def parse_path_points(d):
+    """Parses an svg path `d` attribute into an (n, 2) array of points.
+
+    Mirrors the point list svglib builds for polylines: moves and lines add a
+    point, closepath adds none and subpaths are concatenated. Curves and arcs
+    only contribute their end point.
+    """
+    tokens = SVG_PATH_TOKEN.findall(d)
+    points = []
+    x = y = start_x = start_y = 0.
+    command = None
+    i = 0
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            command = tokens[i]
+            i += 1
+            if command in "Zz":
+                x, y = start_x, start_y
+                continue
+        arity = SVG_PATH_ARITY[command.upper()]
+        args = [float(t) for t in tokens[i:i + arity]]
+        i += arity
+        relative = command.islower()
+        upper = command.upper()
+        if upper == "H":
+            x = args[0] + (x if relative else 0.)
+        elif upper == "V":
+            y = args[0] + (y if relative else 0.)
+        else:
+            x = args[-2] + (x if relative else 0.)
+            y = args[-1] + (y if relative else 0.)
+        if upper == "M":
+            start_x, start_y = x, y
+            # implicit lineto for the following coordinate pairs
+            command = "l" if relative else "L"
+        points.append((x, y))
+    return np.array(points, dtype=np.float64).reshape(-1, 2)
+
+def parse_stroke_width(element, inherited):
+    style = element.get("style")
+    if style:
+        for declaration in style.split(";"):
+            name, _, value = declaration.partition(":")
+            if name.strip() == "stroke-width":
+                return parse_length(value, inherited)
+    return parse_length(element.get("stroke-width"), inherited)
+
+def parse_length(value, default):
+    if value is None:
+        return default
+    match = re.match(SVG_NUMBER, value.strip())
+    return float(match.group(0)) if match else default
+
+def load_svg_tree(source):
+    """Returns the root element of an svg given as a path, bytes or lxml tree."""
+    if isinstance(source, etree._ElementTree):
+        return source.getroot()
+    if isinstance(source, etree._Element):
+        return source
+    parser = etree.XMLParser(remove_comments=True, recover=True)
+    if isinstance(source, bytes):
+        return etree.fromstring(source, parser=parser)
+    return etree.parse(str(source), parser=parser).getroot()
+
+def rescale_svg(svg, viewbox=None, output_size=None):
+    """Rewrites the viewBox and size of the root svg element in place."""
+    if viewbox is not None:
+        svg.set("viewBox", " ".join(f"{v:g}" for v in viewbox))
+    if output_size is not None:
+        svg.set("width", str(output_size))
+        svg.set("height", str(output_size))
+    return svg
+
+def read_svg_geometry(source):
+    """Collects the raw geometry of an svg with lxml.
+    Bytes are streamed with iterparse, an already parsed tree is walked.
+    Stroke widths are inherited from parent groups like svglib does,
+    element transforms are ignored just like the pipeline ignores them.
+
+    Returns:
+        SVGGeometry
+    """
+    geometry = SVGGeometry()
+    lines = {}
+    circles = {}
+    stroke_widths = [1.]
+    streaming = isinstance(source, bytes)
+    if streaming:
+        events = etree.iterparse(
+            io.BytesIO(source), events=("start", "end"), remove_comments=True, recover=True
+        )
+    else:
+        events = etree.iterwalk(load_svg_tree(source), events=("start", "end"))
+    for event, element in events:
+        if event == "end":
+            stroke_widths.pop()
+            if streaming and len(stroke_widths) > 1:
+                element.clear()
+            continue
+        if not isinstance(element.tag, str):
+            # comments and processing instructions of a parsed tree
+            stroke_widths.append(stroke_widths[-1])
+            continue
+
+        stroke_width = parse_stroke_width(element, stroke_widths[-1])
+        stroke_widths.append(stroke_width)
+        tag = etree.QName(element).localname
+        if tag == "svg" and geometry.viewbox is None:
+            geometry.width = element.get("width")
+            geometry.height = element.get("height")
+            viewbox = element.get("viewBox")
+            if viewbox:
+                geometry.viewbox = tuple(float(v) for v in viewbox.replace(",", " ").split())
+        elif tag == "path":
+            points = parse_path_points(element.get("d", ""))
+            geometry.paths.setdefault(stroke_width, []).append(points)
+        elif tag == "line":
+            lines.setdefault(stroke_width, []).append(
+                [parse_length(element.get(k), 0.) for k in ("x1", "y1", "x2", "y2")])
+        elif tag == "circle":
+            circles.setdefault(stroke_width, []).append(
+                [parse_length(element.get(k), 0.) for k in ("cx", "cy", "r")])
+
+    geometry.lines = {k: np.array(v, dtype=np.float64) for k, v in lines.items()}
+    geometry.circles = {k: np.array(v, dtype=np.float64) for k, v in circles.items()}
+    return geometry
@@ -0,0 +1,7 @@
+"""
+This package holds the terrain engine, adapted from https://github.com/dandrino/terrain-erosion-3-ways
+Author: rvorias
+"""
+
+from .graph import compute_height, compute_river_network, compute_final_height
+from . import util, noise
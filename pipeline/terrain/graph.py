@@ -0,0 +1,187 @@
+"""
+This file holds the graph passes of the terrain engine.
+Neighbors are CSR arrays: the neighbors of point k are indices[indptr[k]:indptr[k + 1]],
+as returned by scipy's Delaunay.vertex_neighbor_vertices.
+The kernels are compiled with numba when it is installed, they release the GIL.
+Author: rvorias
+"""
+
+import heapq
+from math import sqrt
+
+import numpy as np
+
+from .util import normalize
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+import logging
+logger = logging.getLogger("realms")
+
+
+def _height_kernel(points, indptr, indices, deltas, volume, downstream,
+                   max_delta, river_downcutting_constant, downcut):
+    """Dijkstra over the point graph, starting from the point closest to the origin.
+    With `downcut` the step cost is lowered along rivers, see compute_final_height().
+    """
+    n = len(points)
+    result = np.zeros(n)
+    done = np.zeros(n, dtype=np.bool_)
+    seed_idx = np.argmin(points[:, 0] + points[:, 1])
+    q = [(0.0, seed_idx)]
+
+    while len(q) > 0:
+        height, idx = heapq.heappop(q)
+        if done[idx]:
+            continue
+        done[idx] = True
+        result[idx] = height
+        for p in range(indptr[idx], indptr[idx + 1]):
+            dst = indices[p]
+            if done[dst]:
+                continue
+            if downcut:
+                # dst is upstream of idx
+                v = volume[dst] if downstream[dst] == idx else 0.0
+                delta = min(max_delta, deltas[dst] / (1.0 + v ** river_downcutting_constant))
+            else:
+                delta = deltas[dst]
+            heapq.heappush(q, (delta + height, dst))
+    return result
+
+
+def _river_kernel(points, indptr, indices, heights, land,
+                  directional_inertia, default_water_level, evaporation_rate):
+    """Grows rivers from the sea upwards, see compute_river_network()."""
+    n = len(points)
+
+    # all edges from sea points to land points, (priority, i, j, direction)
+    q = [(0.0, 0, 0, 0.0, 0.0)]
+    q.pop()
+    for i in range(n):
+        if land[i]:
+            continue
+        for p in range(indptr[i], indptr[i + 1]):
+            j = indices[p]
+            if land[j]:
+                dx = points[j, 0] - points[i, 0]
+                dy = points[j, 1] - points[i, 1]
+                norm = sqrt(dx * dx + dy * dy)
+                heapq.heappush(q, (-1.0, i, j, dx / norm, dy / norm))
+
+    downstream = np.full(n, -1, dtype=np.int64)
+    order = np.empty(n, dtype=np.int64) # points in the order they got their downstream point
+    n_order = 0
+    while len(q) > 0:
+        _, i, j, dx, dy = heapq.heappop(q)
+        if downstream[j] >= 0:
+            continue
+        downstream[j] = i
+        order[n_order] = j
+        n_order += 1
+
+        for p in range(indptr[j], indptr[j + 1]):
+            k = indices[p]
+            if heights[k] < heights[j] or downstream[k] >= 0 or not land[k]:
+                continue
+            # edges aligned with the current direction go first
+            nx = points[k, 0] - points[j, 0]
+            ny = points[k, 1] - points[j, 1]
+            norm = sqrt(nx * nx + ny * ny)
+            nx /= norm
+            ny /= norm
+            priority = -(dx * nx + dy * ny)
+            wx = (1 - directional_inertia) * nx + directional_inertia * dx
+            wy = (1 - directional_inertia) * ny + directional_inertia * dy
+            heapq.heappush(q, (priority, j, k, wx, wy))
+
+    # points are assigned after their downstream point, reversed is upstream first
+    inflow = np.zeros(n)
+    volume = np.zeros(n)
+    for o in range(n_order - 1, -1, -1):
+        j = order[o]
+        volume[j] = (default_water_level + inflow[j]) * (1 - evaporation_rate)
+        inflow[downstream[j]] += volume[j]
+    for j in range(n):
+        if downstream[j] < 0:
+            volume[j] = (default_water_level + inflow[j]) * (1 - evaporation_rate)
+    return downstream, volume
+
+
+if njit is not None:
+    _height_kernel = njit(cache=True, nogil=True)(_height_kernel)
+    _river_kernel = njit(cache=True, nogil=True)(_river_kernel)
+else:
+    logger.warning("numba is not installed, the terrain kernels run uncompiled")
+
+
+def _csr(indptr, indices):
+    return np.ascontiguousarray(indptr, dtype=np.int64), np.ascontiguousarray(indices, dtype=np.int64)
+
+
+def compute_height(points, indptr, indices, deltas, normalized=True):
+    """Dijkstra over the point graph, starting from the point closest to the origin.
+
+    Args:
+        points:         (n, 2) sample points.
+        indptr, indices: CSR neighbors.
+        deltas:         (n,) cost of stepping onto each point.
+        normalized:     scale the heights to [0, 1].
+
+    Returns:
+        (n,) heights.
+    """
+    indptr, indices = _csr(indptr, indices)
+    height = _height_kernel(
+        np.ascontiguousarray(points, dtype=np.float64), indptr, indices,
+        np.ascontiguousarray(deltas, dtype=np.float64),
+        np.zeros(0), np.zeros(0, dtype=np.int64), 0., 0., False)
+    return normalize(height) if normalized else height
+
+
+def compute_river_network(points, indptr, indices, heights, land,
+                          directional_inertia, default_water_level,
+                          evaporation_rate):
+    """Grows rivers from the sea upwards, preferring the current river direction.
+
+    Args:
+        points:                 (n, 2) sample points.
+        indptr, indices:        CSR neighbors.
+        heights:                (n,) heights, rivers never flow uphill.
+        land:                   (n,) bool, True for land points.
+        directional_inertia:    how straight the rivers are (0 = none, 1 = total).
+        default_water_level:    water assigned to each point.
+        evaporation_rate:       fraction of water lost along each river edge.
+
+    Returns:
+        (downstream, volume): (n,) index of the downstream point of each point
+        (-1 for none) and (n,) water volume of each point.
+    """
+    indptr, indices = _csr(indptr, indices)
+    return _river_kernel(
+        np.ascontiguousarray(points, dtype=np.float64), indptr, indices,
+        np.ascontiguousarray(heights, dtype=np.float64),
+        np.ascontiguousarray(land, dtype=np.bool_),
+        float(directional_inertia), float(default_water_level), float(evaporation_rate))
+
+
+def compute_final_height(points, indptr, indices, deltas, volume, downstream,
+                         max_delta, river_downcutting_constant, normalized=True):
+    """compute_height where rivers cut into the terrain.
+
+    Args:
+        volume, downstream:         output of compute_river_network.
+        max_delta:                  maximum height difference between neighbors (talus slippage).
+        river_downcutting_constant: how deeply rivers cut into the terrain.
+    """
+    indptr, indices = _csr(indptr, indices)
+    height = _height_kernel(
+        np.ascontiguousarray(points, dtype=np.float64), indptr, indices,
+        np.ascontiguousarray(deltas, dtype=np.float64),
+        np.ascontiguousarray(volume, dtype=np.float64),
+        np.ascontiguousarray(downstream, dtype=np.int64),
+        float(max_delta), float(river_downcutting_constant), True)
+    return normalize(height) if normalized else height
@@ -0,0 +1,33 @@
+"""
+This file holds the array helpers of the terrain engine,
+ported from util.py of https://github.com/dandrino/terrain-erosion-3-ways.
+The noise and filters of that file live in noise.py.
+Author: rvorias
+"""
+
+import numpy as np
+import scipy.spatial
+
+
+def normalize(x):
+    """Scales `x` to [0, 1], keeps its dtype."""
+    lo, hi = x.min(), x.max()
+    return (x - lo) / (hi - lo)
+
+
+def make_grid_points(shape):
+    """(row, col) of every pixel of `shape`, row major."""
+    [Y, X] = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]))
+    return np.column_stack([X.flatten(), Y.flatten()])
+
+
+def dist_to_mask(mask):
+    """Distance of every pixel to the border of `mask`."""
+    mask = np.asarray(mask, dtype=int)
+    border_mask = (np.maximum.reduce([
+        np.roll(mask, 1, axis=0), np.roll(mask, -1, axis=0),
+        np.roll(mask, -1, axis=1), np.roll(mask, 1, axis=1)]) * (1 - mask))
+    border_points = np.column_stack(np.where(border_mask > 0))
+    kdtree = scipy.spatial.cKDTree(border_points)
+    grid_points = make_grid_points(mask.shape)
+    return kdtree.query(grid_points)[0].reshape(mask.shape)
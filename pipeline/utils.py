@@ -1,26 +1,63 @@
-import sys
-sys.path.append("terrain-erosion-3-ways/")
-from river_network import *
-
 import numpy as np
+import scipy.ndimage
+import scipy.sparse
+import scipy.spatial
 from random import random, Random
 from math import cos, sin, floor, sqrt, pi, ceil
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from functools import partial
+from traceback import format_exception
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+from cache import hash_key, save_array_dir, load_array_dir
+from metrics import StageTimer, stage_started
+from terrain import util, noise, compute_height, compute_river_network, compute_final_height
+
 import logging
 logger = logging.getLogger("realms")
 
 class Step:
-    """This class is used as a wrapper for pipeline steps."""
-    def __init__(self, text, realm_number):
+    """This class is used as a wrapper for pipeline steps.
+    Given a RealmMetrics, it records the time, memory and tracked array shapes of the step.
+    A failing step writes its traceback to `error_dir`/<realm>.txt.
+    """
+    def __init__(self, text, realm_number, metrics=None, error_dir="output/errors"):
         self.text = text
+        self.stage = text.strip("- ")
         self.realm_number = realm_number
+        self.metrics = metrics
+        self.error_dir = Path(error_dir)
+        self.shapes = {}
     def __enter__(self):
         logger.info(self.text)
-    def __exit__(self ,type, value, traceback):
-        if type != None:
-            with open(f"output/errors/{self.realm_number}.txt", "w") as f:
-                f.write(value)
+        stage_started(self.realm_number, self.stage)
+        if self.metrics is not None:
+            self.timer = StageTimer(self.metrics.trace_memory)
+            self.timer.start()
+        return self
+    def track(self, **arrays):
+        """Adds the shapes of `arrays` to the metrics of this step."""
+        self.shapes.update({k: list(np.shape(v)) for k, v in arrays.items()})
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is not None:
+            self.error_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.error_dir / f"{self.realm_number}.txt", "w") as f:
+                f.write(f"stage: {self.stage}\n")
+                f.write("".join(format_exception(exc_type, exc_value, exc_tb)))
+        if self.metrics is not None:
+            record = {"stage": self.stage, **self.timer.stop(), "failed": exc_type is not None}
+            if self.shapes:
+                record["shapes"] = self.shapes
+            self.metrics.add(record)
+            if exc_type is not None:
+                self.metrics.save()
         logger.info("    \---DONE")
 
 def imshow(image, title=None):
@@ -35,6 +72,26 @@ def norm(x, n=None):
         n = x
     return (x - n.min()) / (n.max() - n.min())
 
+def scale_height_map(combined, height_scale):
+    """Normalizes `combined` to [0, 1] and multiplies the heights above the coast
+    (height 0 in `combined`) by `height_scale`, in place, keeping the dtype.
+
+    Returns:
+        (hmap, rescaled coast height)
+    """
+    hmap = norm(combined)
+    rescaled_coast_height = norm(0., combined)
+    # (hmap - coast) * scale + coast above the coast, in place
+    above_coast = hmap > rescaled_coast_height
+    np.subtract(hmap, rescaled_coast_height, out=hmap, where=above_coast)
+    np.multiply(hmap, height_scale, out=hmap, where=above_coast)
+    np.add(hmap, rescaled_coast_height, out=hmap, where=above_coast)
+    return hmap, rescaled_coast_height
+
+def to_grey(hmap):
+    """[0, 1] height map to the uint8 grey levels of the exported png."""
+    return (hmap * 255).astype(np.uint8)
+
 def euclidean_distance(a, b):
     dx = a[0] - b[0]
     dy = a[1] - b[1]
@@ -94,6 +151,289 @@ def poisson_disc_samples(width, height, r, k=5, distance=euclidean_distance, ran
     p = [p for p in grid if p is not None]
     return np.asarray(p)
 
+def _bridson_kernel(random):
+    """Bridson sampling on flat arrays, drawing uniform numbers in [0, 1) from `random`.
+    The grid holds point indices (-1 is empty) and the active list is an index queue.
+    `random` is a closure variable rather than an argument, so numba can cache the kernel.
+    """
+    def kernel(width, height, r, k):
+        cellsize = r / sqrt(2)
+        grid_width = int(ceil(width / cellsize))
+        grid_height = int(ceil(height / cellsize))
+        grid = np.full(grid_width * grid_height, -1, dtype=np.int64)
+        points = np.empty((grid_width * grid_height, 2), dtype=np.float64)
+        queue = np.empty(grid_width * grid_height, dtype=np.int64)
+        sq_r = r * r
+
+        points[0, 0] = width * random()
+        points[0, 1] = height * random()
+        grid[int(points[0, 0] / cellsize) + int(points[0, 1] / cellsize) * grid_width] = 0
+        queue[0] = 0
+        n_points = 1
+        n_queue = 1
+
+        while n_queue > 0:
+            qi = int(random() * n_queue)
+            q = queue[qi]
+            queue[qi] = queue[n_queue - 1]
+            n_queue -= 1
+            qx = points[q, 0]
+            qy = points[q, 1]
+            for _ in range(k):
+                alpha = 2 * pi * random()
+                d = r * sqrt(3 * random() + 1)
+                px = qx + d * cos(alpha)
+                py = qy + d * sin(alpha)
+                if not (0 <= px < width and 0 <= py < height):
+                    continue
+                gx = int(px / cellsize)
+                gy = int(py / cellsize)
+                fits = True
+                for x in range(max(gx - 2, 0), min(gx + 3, grid_width)):
+                    for y in range(max(gy - 2, 0), min(gy + 3, grid_height)):
+                        g = grid[x + y * grid_width]
+                        if g < 0:
+                            continue
+                        dx = px - points[g, 0]
+                        dy = py - points[g, 1]
+                        if dx * dx + dy * dy <= sq_r:
+                            fits = False
+                            break
+                    if not fits:
+                        break
+                if not fits:
+                    continue
+                points[n_points, 0] = px
+                points[n_points, 1] = py
+                grid[gx + gy * grid_width] = n_points
+                queue[n_queue] = n_points
+                n_points += 1
+                n_queue += 1
+
+        # same ordering as poisson_disc_samples: grid order, row by row
+        occupied = grid[grid >= 0]
+        return points[occupied]
+    return kernel
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _numba_random():
+        return np.random.random()
+
+    _bridson_compiled = njit(cache=True)(_bridson_kernel(_numba_random))
+
+    @njit(cache=True)
+    def _bridson_seeded(width, height, r, k, seed):
+        # numba keeps its own generator per thread, seeding it leaves np.random alone
+        np.random.seed(seed)
+        return _bridson_compiled(width, height, r, k)
+
+
+def bridson_samples(width, height, r, k=5, seed=42):
+    """
+    Drop-in replacement of poisson_disc_samples with a compiled kernel.
+    Same algorithm and distribution, seeded by `seed` instead of a python PRNG,
+    so the points are deterministic but differ from poisson_disc_samples.
+    """
+    if njit is None:
+        logger.warning("numba is not installed, bridson_samples runs uncompiled")
+        # a local generator with the same stream as numba's seeded one, np.random is left alone
+        kernel = _bridson_kernel(np.random.RandomState(int(seed)).random_sample)
+        return kernel(float(width), float(height), float(r), int(k))
+    return _bridson_seeded(float(width), float(height), float(r), int(k), int(seed))
+
+
+def sample_points(shape, disc_radius, sampler="python", seed=42):
+    """Samples the terrain points with the sampler chosen in `config.terrain`.
+
+    Args:
+        sampler: "python" for poisson_disc_samples, "bridson" for bridson_samples
+    """
+    if sampler == "bridson":
+        return bridson_samples(*shape, r=disc_radius, seed=seed)
+    if sampler != "python":
+        raise ValueError(f"unknown sampler: {sampler}")
+    prng = Random()
+    prng.seed(seed)
+    return poisson_disc_samples(*shape, r=disc_radius, random=prng.random)
+
+
+TRIANGULATION_VERSION = 2
+_triangulations = {} # per process, workers load each triangulation once
+_triangulations_lock = threading.Lock() # threads of one process (tiles, basins) build it once
+
+
+def barycentric_weights(tri, pixels):
+    """Interpolation weights of `pixels` in a Delaunay triangulation.
+
+    Returns:
+        (weights, weight_points, simplex): the (m, 3) barycentric weights of each
+        pixel, the (m, 3) points they apply to and the (m,) simplex of each pixel
+        (-1 outside of the hull, those pixels extrapolate from the last simplex).
+    """
+    simplex = tri.find_simplex(pixels)
+    transform = tri.transform[simplex]
+    b = np.einsum('...ij,...j->...i', transform[:, :2], pixels - transform[:, 2])
+    weights = np.c_[b, 1 - b.sum(axis=1)]
+    return weights, tri.simplices[simplex].astype(np.int32), simplex
+
+
+def interpolation_matrix(weights, weight_points, n_points):
+    """Sparse (m, n_points) matrix with the 3 weights of each pixel on its row."""
+    m = len(weights)
+    return scipy.sparse.csr_matrix(
+        (np.ravel(weights), np.ravel(weight_points), np.arange(0, 3 * m + 1, 3)),
+        shape=(m, n_points))
+
+
+def build_triangulation(shape, disc_radius, sampler="python", seed=42):
+    """Samples the terrain points and triangulates them.
+
+    Returns:
+        dict of arrays:
+            points, coords:         (n, 2) sample points and their pixel
+            simplices:              the Delaunay simplices
+            indptr, indices:        CSR neighbors, neighbors of k are indices[indptr[k]:indptr[k + 1]]
+            weights, weight_points: barycentric interpolation of every pixel in `shape`,
+                                    see barycentric_weights()
+    """
+    points = sample_points(shape, disc_radius, sampler=sampler, seed=seed)
+    tri = scipy.spatial.Delaunay(points)
+    indptr, indices = tri.vertex_neighbor_vertices
+    weights, weight_points, _ = barycentric_weights(tri, np.indices(shape).reshape(2, -1).T)
+    return dict(
+        points=points,
+        coords=np.floor(points).astype(int),
+        simplices=tri.simplices,
+        indptr=indptr,
+        indices=indices,
+        weights=weights,
+        weight_points=weight_points,
+    )
+
+
+def load_triangulation(shape, disc_radius, sampler="python", seed=42, cache_dir=None):
+    """Returns build_triangulation(), which only depends on its arguments,
+    plus `interpolation`: the sparse matrix that renders point values to pixels.
+    It is built once per process and, given a `cache_dir`, once on disk.
+    Cached arrays are memory-mapped read-only, so workers share the pages.
+    """
+    shape = tuple(int(d) for d in shape)
+    key = hash_key(TRIANGULATION_VERSION, shape, float(disc_radius), sampler, seed)
+    with _triangulations_lock:
+        if key in _triangulations:
+            return _triangulations[key]
+
+        tri = None
+        if cache_dir is not None:
+            path = Path(cache_dir) / key
+            tri = load_array_dir(path)
+            if tri is None:
+                save_array_dir(path, **build_triangulation(shape, disc_radius, sampler, seed))
+                tri = load_array_dir(path)
+        if tri is None:
+            tri = build_triangulation(shape, disc_radius, sampler, seed)
+        tri["interpolation"] = interpolation_matrix(tri["weights"], tri["weight_points"], len(tri["points"]))
+        _triangulations[key] = tri
+        return tri
+
+
+def subset_triangulation(tri, region):
+    """Triangulates only the cached points that fall inside `region`.
+    Delaunay and the interpolation rows are recomputed on every call, the
+    caches of load_triangulation() only provide the points.
+
+    Args:
+        tri:    arrays of load_triangulation().
+        region: (h, w) bool mask of the pixels to keep.
+
+    Returns:
+        see triangulate_subset()
+    """
+    coords = tri["coords"]
+    return triangulate_subset(tri, region[coords[:, 0], coords[:, 1]], np.argwhere(region))
+
+
+def triangulate_subset(tri, keep, pixels):
+    """Triangulates the points of `tri` selected by `keep`.
+
+    Args:
+        tri:    arrays of load_triangulation().
+        keep:   (n,) bool, the points to keep.
+        pixels: (m, 2) pixels to interpolate, the rows of the interpolation matrix.
+
+    Returns:
+        dict with the keys of load_triangulation(), plus `pixels`. Pixels outside
+        of the hull get no weights. None if fewer than 3 points are kept.
+    """
+    if np.count_nonzero(keep) < 3:
+        return None
+    points = np.asarray(tri["points"])[keep]
+    sub = scipy.spatial.Delaunay(points)
+    indptr, indices = sub.vertex_neighbor_vertices
+    weights, weight_points, simplex = barycentric_weights(sub, pixels)
+    weights[simplex < 0] = 0
+    return dict(
+        points=points,
+        coords=tri["coords"][keep],
+        simplices=sub.simplices,
+        indptr=indptr,
+        indices=indices,
+        weights=weights,
+        weight_points=weight_points,
+        interpolation=interpolation_matrix(weights, weight_points, len(points)),
+        pixels=pixels,
+    )
+
+
+def basin_triangulations(tri, land_mask, region):
+    """Splits `region` by connected land component and triangulates each part.
+    Sea pixels of `region` belong to the component of the closest land pixel.
+    Basins never exchange water, so their terrain can be generated independently.
+
+    Returns:
+        list of triangulate_subset() dicts, basins with too few points are left out.
+    """
+    labels, n_basins = scipy.ndimage.label(land_mask)
+    nearest = scipy.ndimage.distance_transform_edt(
+        ~land_mask, return_distances=False, return_indices=True)
+    labels = labels[nearest[0], nearest[1]]
+    del nearest
+    labels[~region] = 0
+
+    coords = tri["coords"]
+    point_labels = labels[coords[:, 0], coords[:, 1]]
+    basins = []
+    for b, slc in enumerate(scipy.ndimage.find_objects(labels), start=1):
+        if slc is None:
+            continue
+        pixels = np.argwhere(labels[slc] == b) + [slc[0].start, slc[1].start]
+        try:
+            basin = triangulate_subset(tri, point_labels == b, pixels)
+        except RuntimeError as e: # qhull on degenerate point sets
+            logger.debug(f"skipping basin {b}: {e}")
+            continue
+        if basin is not None:
+            basins.append(basin)
+    return basins
+
+
+def render_cached_triangulation(shape, tri, values, dtype=np.float64, out=None):
+    """Renders point `values` to pixels with a single sparse mat-vec on the
+    interpolation matrix of load_triangulation().
+    For subset_triangulation() only its pixels are rendered, the rest is 0
+    or left as it is in `out`.
+    """
+    rendered = tri["interpolation"] @ values
+    if "pixels" not in tri:
+        return rendered.reshape(shape).astype(dtype, copy=False)
+    result = np.zeros(shape, dtype=dtype) if out is None else out
+    pixels = tri["pixels"]
+    result[pixels[:, 0], pixels[:, 1]] = rendered
+    return result
+
+
 def filter_within_bounds(coordinates, width, height, svgpad):
     """This operates on uncropped coordinates, that is why we argpass svgpad"""
     logging.debug(f"filtering within: [{svgpad}, {width-svgpad}[, [{svgpad}, {height-svgpad}[")
@@ -114,49 +454,205 @@ def generate_terrain(
     default_water_level=1.0,
     evaporation_rate=0.1,
     coastal_dropoff=50., # high: very small slope towards sea, low: abrupt change to sea
+    sampler="python",
+    land_only=False,
+    coastal_margin=8.,
+    cache_dir=None,
+    basins=False,
+    basin_workers=4,
+    rivers=True,
+    rng=None,
+    dtype=np.float64,
 ):
     """
-    Modified version of https://github.com/dandrino/terrain-erosion-3-ways
+    Modified version of https://github.com/dandrino/terrain-erosion-3-ways,
+    the graph passes run on the compiled kernels of the terrain package.
     Will Largely take in parameters from the config file.
+    The sample points and their triangulation are the same for every realm
+    of a given shape, see load_triangulation().
+    With `land_only` only the points on land and within `coastal_margin` pixels
+    of the coast are triangulated and eroded, the sea is filled with 0.
+    That is a different graph than the full square, so the heights differ from the
+    default mode (the height pass starts from another point), and the subset is
+    triangulated again for every realm, see subset_triangulation().
+    With `basins` (implies `land_only`) every connected landmass is eroded on its
+    own, in `basin_workers` threads, see basin_triangulations().
+    Without `rivers` no river network is grown, the terrain only gets talus slippage.
+    The mountain noise is drawn from `rng` (np.random.Generator) or np.random.
+    The noise and the erosion deltas are computed in `dtype`, and so is the returned height map.
     """
     dim = mask.shape[0]
     shape = (dim,) * 2
     print('  ...initial terrain shape')
     land_mask = mask > 0
-    coastal_dropoff = np.tanh(util.dist_to_mask(land_mask) / coastal_dropoff) * land_mask
-    mountain_shapes = util.fbm(shape, -2, lower=2.0, upper=np.inf)
-    initial_height = ( 
-      (util.gaussian_blur(np.maximum(mountain_shapes - 0.40, 0.0), sigma=5.0) 
-        + 0.1) * coastal_dropoff)
-    deltas = util.normalize(np.abs(util.gaussian_gradient(initial_height))) 
-
-    print('  ...sampling points')
-#     points = util.poisson_disc_sampling(shape, disc_radius)
-    prng = Random()
-    prng.seed(42)
-    points = poisson_disc_samples(*shape, r=disc_radius, random=prng.random)
-    coords = np.floor(points).astype(int)
-
-    print('  ...delaunay triangulation')
-    tri = sp.spatial.Delaunay(points)
-    (indices, indptr) = tri.vertex_neighbor_vertices
-    neighbors = [indptr[indices[k]:indices[k + 1]] for k in range(len(points))]
+    if not land_mask.any():
+        logger.warning("no land to generate terrain on")
+        return np.zeros(shape, dtype=dtype)
+    dist_to_coast = util.dist_to_mask(land_mask)
+    coastal_dropoff = np.tanh(dist_to_coast / coastal_dropoff).astype(dtype) * land_mask
+    mountain_shapes = noise.fbm(shape, -2, lower=2.0, upper=np.inf, rng=rng, dtype=dtype)
+    initial_height = np.maximum(mountain_shapes - 0.40, 0.0, out=mountain_shapes)
+    initial_height = noise.gaussian_blur(initial_height, sigma=5.0, dtype=dtype)
+    initial_height += 0.1
+    initial_height *= coastal_dropoff
+    deltas = util.normalize(np.abs(noise.gaussian_gradient(initial_height, dtype=dtype)))
+
+    print('  ...sampling points and delaunay triangulation')
+    tri = load_triangulation(shape, disc_radius, sampler=sampler, cache_dir=cache_dir)
+    erode = partial(
+        erode_points, land_mask=land_mask, deltas=deltas,
+        max_delta=max_delta, river_downcutting_constant=river_downcutting_constant,
+        directional_inertia=directional_inertia, default_water_level=default_water_level,
+        evaporation_rate=evaporation_rate, rivers=rivers)
+
+    if basins:
+        region = land_mask | (dist_to_coast <= coastal_margin)
+        basin_tris = basin_triangulations(tri, land_mask, region)
+        print(f'  ...height, rivers and erosion of {len(basin_tris)} basins')
+        with ThreadPoolExecutor(max_workers=basin_workers) as executor:
+            heights = list(executor.map(erode, basin_tris))
+        if not heights:
+            logger.warning("no land to generate terrain on")
+            return np.zeros(shape, dtype=dtype)
+        # normalized over all basins, as if they were one network
+        lo = min(h.min() for h in heights)
+        hi = max(h.max() for h in heights)
+        result = np.zeros(shape, dtype=dtype)
+        for basin, height in zip(basin_tris, heights):
+            render_cached_triangulation(shape, basin, (height - lo) / (hi - lo), out=result)
+        return result
+
+    if land_only:
+        tri = subset_triangulation(tri, land_mask | (dist_to_coast <= coastal_margin))
+        if tri is None:
+            logger.warning("no land to generate terrain on")
+            return np.zeros(shape, dtype=dtype)
+    print('  ...height, rivers and erosion')
+    new_height = util.normalize(erode(tri))
+    return render_cached_triangulation(shape, tri, new_height, dtype=dtype)
+
+
+def erode_points(
+    tri,
+    land_mask,
+    deltas,
+    max_delta,
+    river_downcutting_constant,
+    directional_inertia,
+    default_water_level,
+    evaporation_rate,
+    rivers=True,
+):
+    """Runs the height, river network and erosion passes on the points of `tri`.
+    Without `rivers` the erosion pass has no river to cut, only `max_delta` applies.
+
+    Returns:
+        (n,) final height of each point, not normalized.
+    """
+    coords = tri["coords"]
+    points = tri["points"]
+    indptr, indices = tri["indptr"], tri["indices"]
     points_land = land_mask[coords[:, 0], coords[:, 1]]
     points_deltas = deltas[coords[:, 0], coords[:, 1]]
 
-    print('  ...initial height map')
-    points_height = compute_height(points, neighbors, points_deltas)
+    if not rivers:
+        n = len(points)
+        return compute_final_height(
+          points, indptr, indices, points_deltas, np.zeros(n), np.full(n, -1),
+          max_delta, river_downcutting_constant, normalized=False)
+
+    points_height = compute_height(points, indptr, indices, points_deltas)
 
-    print('  ...river network')
-    (upstream, downstream, volume) = compute_river_network(
-      points, neighbors, points_height, points_land,
+    (downstream, volume) = compute_river_network(
+      points, indptr, indices, points_height, points_land,
       directional_inertia, default_water_level, evaporation_rate)
 
-    print('  ...final terrain height')
-    new_height = compute_final_height(
-      points, neighbors, points_deltas, volume, upstream, 
-      max_delta, river_downcutting_constant)
-    return render_triangulation(shape, tri, new_height)
+    return compute_final_height(
+      points, indptr, indices, points_deltas, volume, downstream,
+      max_delta, river_downcutting_constant, normalized=False)
+
+
+def _ramp(size, halo):
+    """1d blending weights of a tile, linear over the 2 * halo pixels of each side,
+    overlapping tiles add up to 1."""
+    if halo <= 0:
+        return np.ones(size)
+    x = np.arange(size) + 0.5
+    return np.minimum(x, size - x).clip(0, 2 * halo) / (2 * halo)
+
+
+def generate_terrain_tiled(
+    mask,
+    tile_size=1024,
+    halo=64,
+    coarse_size=1000,
+    detail=1.0,
+    workers=4,
+    rng=None,
+    dtype=np.float64,
+    **terrain_kwargs,
+):
+    """generate_terrain for realms too large to triangulate at once.
+
+    A coarse pass over the whole realm at `coarse_size` resolves the river network
+    globally and is the only pass that carves rivers, so they stay continuous. The
+    full resolution is then generated in tiles of `tile_size` with `halo` pixels of
+    overlap, run in `workers` threads (the terrain kernels release the GIL). Tiles
+    are eroded without rivers, a river network per tile would end at its borders.
+    The fine detail of each tile, its height minus a blur at the coarse scale, is
+    blended over the halos with linear ramps and added to the upsampled coarse height.
+    All tiles have the same shape, so they share one cached triangulation, unless
+    `land_only` or `basins` triangulate every tile again.
+
+    Args:
+        detail:         strength of the tile detail on top of the coarse height.
+        rng:            np.random.Generator, drawn from np.random if None.
+        terrain_kwargs: passed on to generate_terrain().
+    """
+    dim = mask.shape[0]
+    if dim <= max(tile_size, coarse_size):
+        return generate_terrain(mask, rng=rng, dtype=dtype, **terrain_kwargs)
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2**31))
+    land_mask = mask > 0
+
+    print('  ...coarse global terrain')
+    coarse_mask = scipy.ndimage.zoom(land_mask.astype(np.uint8), coarse_size / dim, order=0)
+    coarse = generate_terrain(coarse_mask, rng=rng, dtype=dtype, **terrain_kwargs)
+    height = scipy.ndimage.zoom(coarse, dim / coarse.shape[0], order=1, output=dtype)[:dim, :dim]
+    height = np.pad(height, ((0, dim - height.shape[0]), (0, dim - height.shape[1])), mode="edge")
+
+    size = tile_size + 2 * halo
+    n_tiles = int(ceil(dim / tile_size))
+    padded = np.zeros((n_tiles * tile_size + 2 * halo,) * 2, dtype=bool)
+    padded[halo:halo + dim, halo:halo + dim] = land_mask
+    tiles = [(i * tile_size, j * tile_size) for i in range(n_tiles) for j in range(n_tiles)]
+    seeds = rng.integers(2**31, size=len(tiles))
+    sigma = dim / coarse_size
+
+    def run_tile(tile, seed):
+        i, j = tile
+        if not padded[i:i + size, j:j + size].any():
+            return tile, np.zeros((size, size), dtype=dtype)
+        tile_height = generate_terrain(
+            padded[i:i + size, j:j + size], rivers=False, rng=np.random.default_rng(seed),
+            dtype=dtype, **terrain_kwargs)
+        tile_height -= scipy.ndimage.gaussian_filter(tile_height, sigma)
+        return tile, tile_height
+
+    print(f'  ...{len(tiles)} detail tiles')
+    weight = np.outer(_ramp(size, halo), _ramp(size, halo)).astype(dtype)
+    blended = np.zeros(padded.shape, dtype=dtype)
+    weights = np.zeros(padded.shape, dtype=dtype)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (i, j), tile_height in executor.map(run_tile, tiles, seeds):
+            blended[i:i + size, j:j + size] += weight * tile_height
+            weights[i:i + size, j:j + size] += weight
+    blended /= np.maximum(weights, 1e-6)
+
+    height += detail * blended[halo:halo + dim, halo:halo + dim]
+    return height.clip(0, None)
+
 
 def get_wind_direction(direction):
     """Expects radians"""
@@ -8,21 +8,26 @@ from struct import unpack_from as unpack, pack
 
 import click
 import json
+from functools import lru_cache
 
 @click.command()
 @click.argument("realm_number")
 def parse(realm_number):
     operate(realm_number)
 
+@lru_cache(maxsize=None)
+def load_donor(path="voxmaps/donor.vox"):
+    """Parsed donor model, it is only read from, so every realm of a process shares it."""
+    return VoxParser(path).parse()
+
 def operate(realm_number):
     with open(f"output/flood_{realm_number}.json") as json_file:
         data = json.load(json_file)
         water_color = data["steps"][0]["water_color"]
 
-    donor = VoxParser("voxmaps/donor.vox")
     acceptor = VoxParser(f"voxmaps/wmap_{realm_number}.vox")
 
-    m_donor = donor.parse()
+    m_donor = load_donor()
     m_acceptor = acceptor.parse()
 
     print(water_color)
@@ -0,0 +1,10 @@
+"""
+This file holds the shared test setup.
+The pipeline modules import each other flat, as run.py does with sys.path.append("pipeline").
+Author: rvorias
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1] / "pipeline"))
@@ -0,0 +1,124 @@
+"""
+This file holds the reference graph passes of test_terrain_graph.py:
+a port of compute_height, compute_river_network and compute_final_height of
+river_network.py in https://github.com/dandrino/terrain-erosion-3-ways,
+the pure python functions the compiled terrain kernels replace.
+Neighbors are a list of arrays, as in the original.
+Author: rvorias
+"""
+
+import heapq
+
+import numpy as np
+
+
+def normalize(x):
+    return (x - x.min()) / (x.max() - x.min())
+
+
+def lerp(x, y, a):
+    return (1.0 - a) * x + a * y
+
+
+def compute_height(points, neighbors, deltas, get_delta_fn=None):
+    if get_delta_fn is None:
+        get_delta_fn = lambda src, dst: deltas[dst]
+
+    dim = len(points)
+    result = [None] * dim
+    seed_idx = min(range(dim), key=lambda i: points[i].sum())
+    q = [(0.0, seed_idx)]
+
+    while len(q) > 0:
+        (height, idx) = heapq.heappop(q)
+        if result[idx] is not None:
+            continue
+        result[idx] = height
+        for n in neighbors[idx]:
+            if result[n] is not None:
+                continue
+            heapq.heappush(q, (get_delta_fn(idx, n) + height, n))
+    return normalize(np.array(result))
+
+
+def compute_river_network(points, neighbors, heights, land,
+                          directional_inertia, default_water_level,
+                          evaporation_rate):
+    num_points = len(points)
+
+    # The normalized vector between points i and j
+    def unit_delta(i, j):
+        delta = points[j] - points[i]
+        return delta / np.linalg.norm(delta)
+
+    # Initialize river priority queue with all edges between non-land points to
+    # land points. Each entry is a tuple of (priority, (i, j, river direction))
+    q = []
+    for i in range(num_points):
+        if land[i]:
+            continue
+        for j in neighbors[i]:
+            if not land[j]:
+                continue
+            heapq.heappush(q, (-1.0, (i, j, unit_delta(i, j))))
+
+    # Compute the map of each node to its downstream node.
+    downstream = [None] * num_points
+
+    while len(q) > 0:
+        (_, (i, j, direction)) = heapq.heappop(q)
+
+        # Assign i as being downstream of j, assuming such a point doesn't
+        # already exist.
+        if downstream[j] is not None:
+            continue
+        downstream[j] = i
+
+        # Go through each neighbor of upstream point j
+        for k in neighbors[j]:
+            # Ignore neighbors that are lower than the current point, or who already
+            # have an assigned downstream point.
+            if heights[k] < heights[j] or downstream[k] is not None or not land[k]:
+                continue
+
+            # Edges that are more aligned with the current direction vector are
+            # prioritized.
+            neighbor_direction = unit_delta(j, k)
+            priority = -np.dot(direction, neighbor_direction)
+
+            # Add new edge to queue.
+            weighted_direction = lerp(neighbor_direction, direction, directional_inertia)
+            heapq.heappush(q, (priority, (j, k, weighted_direction)))
+
+    # Compute the mapping of each node to its upstream nodes.
+    upstream = [set() for _ in range(num_points)]
+    for i, j in enumerate(downstream):
+        if j is not None:
+            upstream[j].add(i)
+
+    # Compute the water volume for each node.
+    volume = [None] * num_points
+
+    def compute_volume(i):
+        if volume[i] is not None:
+            return
+        v = default_water_level
+        for j in upstream[i]:
+            compute_volume(j)
+            v += volume[j]
+        volume[i] = v * (1 - evaporation_rate)
+
+    for i in range(0, num_points):
+        compute_volume(i)
+
+    return (upstream, downstream, volume)
+
+
+def compute_final_height(points, neighbors, deltas, volume, upstream,
+                         max_delta, river_downcutting_constant):
+    def get_delta(src, dst):
+        v = volume[dst] if dst in upstream[src] else 0.0
+        downcut = 1.0 / (1.0 + v ** river_downcutting_constant)
+        return min(max_delta, deltas[dst] * downcut)
+
+    return compute_height(points, neighbors, deltas, get_delta_fn=get_delta)
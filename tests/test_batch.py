@@ -0,0 +1,53 @@
+"""
+This file holds the tests of the batch driver: attempts survive a resume,
+whatever status the realm was left in, a redo starts counting again, and
+stuck workers time out.
+Author: rvorias
+"""
+
+import time
+
+from batch import Manifest, supervise
+
+
+def failed(realm):
+    return {
+        "job": "heights", "realm": realm, "status": "failed", "stage_keys": {}, "output_hash": None,
+        "error": "boom", "kind": "exception", "stage": "Generating terrain", "stages": [], "wall_s": 1.}
+
+
+def test_attempts_survive_resume(tmp_path):
+    manifest = Manifest(tmp_path / "manifest.sqlite")
+    manifest.mark_running("heights", [(7, "svgs/7.svg"), (8, "svgs/8.svg")])
+    manifest.record(failed(7))
+    # retried, then the batch is killed while both realms are 'running'
+    manifest.mark_running("heights", [(7, "svgs/7.svg")])
+    assert manifest.counts("heights") == {"running": 2}
+
+    # a resumed batch still knows realm 7 failed once
+    assert manifest.attempts("heights") == {7: 1, 8: 0}
+    manifest.close()
+
+
+def test_redo_resets_attempts(tmp_path):
+    manifest = Manifest(tmp_path / "manifest.sqlite")
+    manifest.mark_running("heights", [(7, "svgs/7.svg")])
+    manifest.record(failed(7))
+    manifest.mark_running("heights", [(7, "svgs/7.svg")])
+    manifest.record({**failed(7), "status": "done", "output_hash": "abc"})
+
+    # rerun with redo, the earlier runs do not count towards max_attempts
+    manifest.mark_running("heights", [(7, "svgs/7.svg")])
+    assert manifest.attempts("heights") == {7: 0}
+    manifest.close()
+
+
+def test_timeout_covers_initializer():
+    results = []
+    start = time.perf_counter()
+    supervise(
+        [("heights", 7, "svgs/7.svg", "pipeline/config.yaml")], pool_size=1, timeout_s=1,
+        on_result=lambda result, retry: results.append(result),
+        initializer=time.sleep, initargs=(60,))
+    assert [(r["realm"], r["kind"]) for r in results] == [(7, "timeout")]
+    assert time.perf_counter() - start < 30
@@ -0,0 +1,62 @@
+"""
+This file holds the float32 tolerance test of the height maps: generate_terrain and the
+scaling and export chain of run_pipeline in float32 stay within 5e-5 of float64 and
+at most one grey level of the exported png. The float64 noise is checked against the
+upstream complex fbm, so float64 is a genuine reference.
+Author: rvorias
+"""
+
+import numpy as np
+import pytest
+
+from terrain import noise, util
+from utils import generate_terrain, scale_height_map, to_grey
+
+DIM = 128
+
+
+@pytest.fixture(scope="module")
+def mask():
+    """Two islands, as the 0/255 mask run_pipeline passes to generate_terrain."""
+    yy, xx = np.mgrid[:DIM, :DIM]
+    land = (np.hypot(yy - 48, xx - 44) < 30) | (np.hypot(yy - 90, xx - 92) < 20)
+    return np.where(land, 255, 0).astype(np.uint8)
+
+
+def run_chain(mask, dtype, height_scale, seed):
+    terrain_height = generate_terrain(
+        mask, disc_radius=2., sampler="bridson", coastal_dropoff=10.,
+        rng=np.random.default_rng(seed), dtype=dtype)
+    assert terrain_height.dtype == dtype
+    hmap, _ = scale_height_map(terrain_height, height_scale)
+    assert hmap.dtype == dtype
+    return hmap, to_grey(hmap)
+
+
+@pytest.mark.parametrize("height_scale", [0.33, 1.0])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_float32_within_tolerance(mask, height_scale, seed):
+    hmap32, grey32 = run_chain(mask, np.float32, height_scale, seed)
+    hmap64, grey64 = run_chain(mask, np.float64, height_scale, seed)
+    assert np.abs(hmap32.astype(np.float64) - hmap64).max() <= 5e-5
+    assert np.abs(grey32.astype(np.int16) - grey64).max() <= 1
+
+
+def upstream_fbm(shape, p, lower=-np.inf, upper=np.inf):
+    """fbm of util.py in terrain-erosion-3-ways, complex FFTs in float64."""
+    freqs = tuple(np.fft.fftfreq(n, d=1.0 / n) for n in shape)
+    freq_radial = np.hypot(*np.meshgrid(*freqs))
+    envelope = (np.power(freq_radial, p, where=freq_radial != 0, out=np.zeros_like(freq_radial)) *
+                (freq_radial > lower) * (freq_radial < upper))
+    envelope[0][0] = 0.0
+    phase_noise = np.exp(2j * np.pi * np.random.rand(*shape))
+    return util.normalize(np.real(np.fft.ifft2(np.fft.fft2(phase_noise) * envelope)))
+
+
+def test_float64_noise_is_upstream():
+    np.random.seed(3)
+    expected = upstream_fbm((DIM, DIM), -2, lower=2.0)
+    np.random.seed(3)
+    mountain_shapes = noise.fbm((DIM, DIM), -2, lower=2.0, dtype=np.float64)
+    assert mountain_shapes.dtype == np.float64
+    np.testing.assert_allclose(mountain_shapes, expected, rtol=0, atol=1e-12)
@@ -0,0 +1,40 @@
+"""
+This file holds the tests of rasterize_polylines against the coverage of every
+pixel computed directly from its distance to every segment.
+Author: rvorias
+"""
+
+import numpy as np
+import pytest
+
+from image_ops import rasterize_polylines
+
+SIZE = 64
+
+
+def expected_coverage(paths, widths):
+    yy, xx = np.mgrid[:SIZE, :SIZE] + 0.5
+    canvas = np.zeros((SIZE, SIZE))
+    for path, width in zip(paths, widths):
+        for (x0, y0), (x1, y1) in zip(path[:-1], path[1:]):
+            dx, dy = x1 - x0, y1 - y0
+            length2 = dx * dx + dy * dy
+            t = (((xx - x0) * dx + (yy - y0) * dy) / length2).clip(0, 1) if length2 > 0 else 0.
+            dist = np.hypot(xx - x0 - t * dx, yy - y0 - t * dy)
+            canvas = np.maximum(canvas, (width / 2 + 0.5 - dist).clip(0, 1))
+    return canvas
+
+
+@pytest.mark.parametrize("max_pixels", [1 << 21, 500])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_rasterize_polylines(seed, max_pixels):
+    rng = np.random.default_rng(seed)
+    # random walks, some leave the canvas, one has a repeated point
+    paths = [np.cumsum(rng.normal(0, 8, size=(20, 2)), axis=0) + 32 for _ in range(5)]
+    paths.append(np.array([[10., 10.], [10., 10.], [50., 30.]]))
+    widths = rng.uniform(0.5, 5, len(paths))
+    widths[0] = 20.
+
+    canvas = rasterize_polylines(paths, widths, output_size=SIZE, max_pixels=max_pixels)
+    assert canvas.dtype == np.float32
+    np.testing.assert_allclose(canvas, expected_coverage(paths, widths), rtol=0, atol=1e-6)
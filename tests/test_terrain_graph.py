@@ -0,0 +1,67 @@
+"""
+This file holds the equivalence tests of the compiled terrain graph passes against
+river_network.py of terrain-erosion-3-ways, ported in tests/river_network.py,
+on small random meshes.
+Author: rvorias
+"""
+
+import numpy as np
+import pytest
+import scipy.spatial
+
+import river_network
+from terrain import compute_height, compute_river_network, compute_final_height
+
+DIRECTIONAL_INERTIA = 0.4
+DEFAULT_WATER_LEVEL = 1.0
+EVAPORATION_RATE = 0.2
+MAX_DELTA = 0.05
+RIVER_DOWNCUTTING_CONSTANT = 1.3
+
+
+@pytest.fixture(params=[0, 1, 2])
+def mesh(request):
+    """Random points on a 64x64 square with a round island in the middle."""
+    rng = np.random.default_rng(request.param)
+    points = rng.uniform(0, 64, size=(400, 2))
+    indptr, indices = scipy.spatial.Delaunay(points).vertex_neighbor_vertices
+    neighbors = [indices[indptr[k]:indptr[k + 1]] for k in range(len(points))]
+    land = np.hypot(*(points - 32).T) < 24
+    deltas = rng.random(len(points))
+    return points, indptr, indices, neighbors, land, deltas
+
+
+def test_compute_height(mesh):
+    points, indptr, indices, neighbors, land, deltas = mesh
+    expected = river_network.compute_height(points, neighbors, deltas)
+    np.testing.assert_array_equal(compute_height(points, indptr, indices, deltas), expected)
+
+
+def test_compute_river_network(mesh):
+    points, indptr, indices, neighbors, land, deltas = mesh
+    heights = compute_height(points, indptr, indices, deltas)
+    _, expected_downstream, expected_volume = river_network.compute_river_network(
+        points, neighbors, heights, land, DIRECTIONAL_INERTIA, DEFAULT_WATER_LEVEL, EVAPORATION_RATE)
+    downstream, volume = compute_river_network(
+        points, indptr, indices, heights, land, DIRECTIONAL_INERTIA, DEFAULT_WATER_LEVEL, EVAPORATION_RATE)
+
+    # the seed edges all have priority -1.0, ties go by (sea point, land point) in both
+    expected_downstream = [-1 if d is None else d for d in expected_downstream]
+    np.testing.assert_array_equal(downstream, expected_downstream)
+    # same sums in a different order
+    np.testing.assert_allclose(volume, expected_volume, rtol=1e-12)
+
+
+def test_compute_final_height(mesh):
+    points, indptr, indices, neighbors, land, deltas = mesh
+    heights = compute_height(points, indptr, indices, deltas)
+    upstream, _, expected_volume = river_network.compute_river_network(
+        points, neighbors, heights, land, DIRECTIONAL_INERTIA, DEFAULT_WATER_LEVEL, EVAPORATION_RATE)
+    expected = river_network.compute_final_height(
+        points, neighbors, deltas, expected_volume, upstream, MAX_DELTA, RIVER_DOWNCUTTING_CONSTANT)
+
+    downstream, volume = compute_river_network(
+        points, indptr, indices, heights, land, DIRECTIONAL_INERTIA, DEFAULT_WATER_LEVEL, EVAPORATION_RATE)
+    final = compute_final_height(
+        points, indptr, indices, deltas, volume, downstream, MAX_DELTA, RIVER_DOWNCUTTING_CONSTANT)
+    np.testing.assert_allclose(final, expected, rtol=0, atol=1e-12)
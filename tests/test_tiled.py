@@ -0,0 +1,68 @@
+"""
+This file holds the tests of the tiled terrain path: generate_terrain_tiled and
+run_pipeline end to end, on small realms with tiles much smaller than the realm.
+Author: rvorias
+"""
+
+import shutil
+from pathlib import Path
+
+import numpy as np
+import PIL.Image
+import pytest
+from omegaconf import OmegaConf
+
+import utils
+from run import run_pipeline
+
+DATA_DIR = Path(__file__).parent / "data"
+CONFIG = Path(__file__).parents[1] / "pipeline" / "config.yaml"
+OUTPUT_SIZE = 600
+
+
+def test_rivers_only_from_coarse_pass(monkeypatch):
+    """Tiles get no river network of their own, rivers come from the one global pass."""
+    networks = []
+    compute_river_network = utils.compute_river_network
+    def count(points, *args):
+        networks.append(len(points))
+        return compute_river_network(points, *args)
+    monkeypatch.setattr(utils, "compute_river_network", count)
+
+    yy, xx = np.mgrid[:160, :160]
+    mask = np.where(np.hypot(yy - 80, xx - 70) < 60, 255, 0).astype(np.uint8)
+    height = utils.generate_terrain_tiled(
+        mask, tile_size=64, halo=8, coarse_size=80, disc_radius=2., sampler="bridson",
+        rng=np.random.default_rng(0))
+
+    assert len(networks) == 1
+    assert height.shape == mask.shape
+    assert height[mask > 0].std() > 0
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    """The pipeline config with tiling enabled, writing into `tmp_path`."""
+    shutil.copytree(DATA_DIR / "svgs", tmp_path / "svgs")
+    monkeypatch.chdir(tmp_path)
+    config = OmegaConf.load(CONFIG)
+    config.pipeline.main_output_dir = str(tmp_path / "output")
+    config.pipeline.cache_dir = str(tmp_path / "cache")
+    config.svg.output_size = OUTPUT_SIZE
+    config.terrain.tiling.enabled = True
+    config.terrain.tiling.tile_size = 256
+    config.terrain.tiling.halo = 16
+    config.terrain.tiling.coarse_size = 200
+    return config
+
+
+def test_tiled_pipeline(config, tmp_path):
+    run_pipeline("svgs/7.svg", config)
+
+    output = tmp_path / "output"
+    assert not (output / "errors" / "7.txt").exists()
+    heights = np.asarray(PIL.Image.open(output / "heights" / "height_7.png"))
+    assert heights.shape == (OUTPUT_SIZE, OUTPUT_SIZE, 2)
+    land = heights[..., 1] > 0
+    assert land.any() and not land.all()
+    assert heights[land, 0].std() > 0